@@ -0,0 +1,210 @@
+import time
+import asyncio
+import aiohttp
+import aiomysql
+
+from PBX import PBX, PBXError
+from PBXPool import SQLPool
+from PBXUtil import sanitary_format, no_such_table
+
+class AsyncPBX(PBX):
+	"""asyncio counterpart of PBX
+
+	Config pages are fetched with aiohttp and queries run on an aiomysql
+	connection pool, so any number of them can be in flight on one event
+	loop. Module tables are read whole, on first use, into the same
+	in-memory snapshots PBX uses in snapshot mode; the blocking Module
+	methods are then served from memory, and Module.aget, afilter and
+	aall load whatever tables and pages they need first:
+
+		pbx = AsyncPBX("10.0.0.2")
+		await pbx.connect_web_config(username, password)
+		await pbx.connect_sql(username, password)
+		ivrs = await pbx["IVR"].aall()
+		await pbx.close()
+
+	Rendering destinations can touch any module, so await preload()
+	before rendering templates. Unlike PBX.load_snapshot, the tables are
+	read concurrently over several connections and so are not a single
+	consistent point-in-time view.
+	"""
+
+	def __init__(self, url, **kwargs):
+		PBX.__init__(self, url, **kwargs)
+		self._http = None
+		self._aio_pool = None
+		self._tunnel_pool = None
+		self._snapshot = {}
+		self._table_loads = {}
+
+	async def connect_web_config( self, username, password ):
+		self._http = aiohttp.ClientSession(auth = aiohttp.BasicAuth(username, password),
+			connector = aiohttp.TCPConnector(limit = self._max_workers))
+
+		try:
+			async with self._http.get(self._url + self._config_base) as r:
+				status = r.status
+		except aiohttp.ClientError:
+			raise PBXError("Cannot connect to PBX")
+
+		if status == 404:
+			raise PBXError("Configuration page not found")
+
+		async with self._http.post(self._url + self._config_base,
+				data = {"username": username, "password": password}) as r:
+			status = r.status
+			content = await r.read()
+
+		if status == 401 or b"Invalid Username or Password" in content:
+			raise PBXError("Invalid username or password")
+
+		self._web_authenticated = True
+
+	async def connect_sql( self, username, password ):
+		# the SSH tunnel and working password are shared with PBX through
+		# SQLPool; the MySQL connections themselves are aiomysql's own
+		self.update_subtask("Opening proxy")
+		loop = asyncio.get_running_loop()
+		tunnel = await loop.run_in_executor(None, SQLPool.for_host,
+			self._base_url, username, password, self._max_workers)
+		self._tunnel_pool = tunnel
+		port = await loop.run_in_executor(None, tunnel.local_port)
+
+		self.update_subtask("Logging in")
+		for attempt in tunnel.password_variants():
+			try:
+				self._aio_pool = await aiomysql.create_pool(host = '127.0.0.1',
+					port = port, user = 'root',
+					password = attempt, db = 'asterisk', maxsize = self._max_workers)
+				tunnel.remember_password(attempt)
+				break
+			except aiomysql.Error:
+				pass
+		else:
+			raise PBXError("Cannot log in to SQL")
+
+		self._sql_connected = True
+		self.update_subtask("Logged in")
+
+		if self._snapshot_mode:
+			await self.load_snapshot()
+
+	def get_sql_cursor( self ):
+		raise PBXError("AsyncPBX has no blocking cursor, use query() or await preload() first")
+
+	def iter_sql( self, q, params = None, batch_size = 500, source = ("PBX", "iter_sql"), key = None ):
+		# Module.iter_all serves loaded tables from the snapshot, so only
+		# a table that was never loaded gets here
+		raise PBXError("AsyncPBX has no blocking cursor, use query() or await preload() first")
+
+	async def query( self, q, params = None, source = ("PBX", "query") ):
+		'''Runs q and returns its rows as dicts
+
+		The query is recorded in stats under the (module, method) source.
+		'''
+		if self._aio_pool is None: raise PBXError()
+
+		async with self._aio_pool.acquire() as conn:
+			async with conn.cursor(aiomysql.DictCursor) as cur:
+				start = time.perf_counter()
+				try:
+					await cur.execute(q, params)
+					return await cur.fetchall()
+				finally:
+					self.stats.sql(source[0], source[1], start, time.perf_counter() - start, q)
+
+	async def load_table( self, cls ):
+		if cls in self._snapshot: return
+
+		# concurrent callers share the one SELECT
+		if cls not in self._table_loads:
+			self._table_loads[cls] = asyncio.ensure_future(self._load_table(cls))
+		try:
+			await self._table_loads[cls]
+		except Exception:
+			# a failed load is tried again by the next caller
+			if self._table_loads[cls].done(): del self._table_loads[cls]
+			raise
+
+	async def _load_table( self, cls ):
+		self.update_subtask("\tLoading table: " + cls.db_table)
+		try:
+			rows = await self.query(sanitary_format("SELECT * FROM {table};", table = cls.db_table),
+				source = ("PBX", "load_snapshot"))
+		except aiomysql.Error as e:
+			if not no_such_table(e): raise
+			rows = []
+
+		self._snapshot[cls] = self.make_table_snapshot(cls, rows)
+
+	async def load_tables( self, classes ):
+		await asyncio.gather(*[self.load_table(cls) for cls in classes if hasattr(cls, "db_table")])
+
+	async def load_snapshot( self ):
+		self.update_status("Loading configuration snapshot")
+		await self.load_tables(self.snapshot_modules())
+
+	async def preload( self ):
+		'''Loads every table and config page, so templates can be rendered'''
+		await self.load_snapshot()
+		await asyncio.gather(*[m.aprepare() for m in self])
+
+	def drop_snapshot( self ):
+		self._snapshot = {}
+		self._table_loads = {}
+		self._call_flow = None
+
+	async def get_config_url( self, url, pin = False ):
+		page = self._page_cache.get(url)
+		if page is not None:
+			self.stats.page_hit(url)
+			return page
+
+		start = time.perf_counter()
+		try:
+			content = await self._fetch_page(url)
+		finally:
+			self.stats.page_miss(url, start, time.perf_counter() - start)
+		return self._page_cache.put(url, content, pin)
+
+	async def _fetch_page( self, url ):
+		cached, meta, headers = self._disk_lookup(url)
+		if cached is not None and meta is None: return cached
+
+		if self._http is None: raise PBXError("could not web auth")
+		async with self._http.get(self._url + url, headers = headers) as r:
+			content = await r.read()
+			return self._scraped_page(url, r.status, content, r.headers, cached, meta)
+
+	async def fetch_pages( self, params_list ):
+		'''Fetches the config pages for params_list concurrently into the page cache
+
+		They are kept there until first read, as prefetch_pages keeps them.
+		'''
+		urls = []
+		for p in params_list:
+			url = self.config_path(p)
+			if url not in self._page_cache and url not in urls: urls.append(url)
+
+		await asyncio.gather(*[self.get_config_url(url, True) for url in urls])
+
+	def prefetch_pages( self, params_list, max_workers = None ):
+		# pages are fetched by fetch_pages before blocking code runs
+		pass
+
+	def get_config_from_param( self, **kwargs ):
+		page = self._page_cache.get(self.config_path(kwargs))
+		if page is None:
+			raise PBXError("Config page not fetched, await fetch_pages() first")
+		return page
+
+	async def close( self ):
+		if self._http is not None:
+			await self._http.close()
+		if self._aio_pool is not None:
+			self._aio_pool.close()
+			await self._aio_pool.wait_closed()
+		if self._tunnel_pool is not None:
+			tunnel, self._tunnel_pool = self._tunnel_pool, None
+			tunnel.detach()
+		PBX.close(self)
@@ -1,109 +1,143 @@
 import PBXUtil
-from copy import copy
+import OutputFormatter
+
+class FieldValue:
+	"""One field of one row, as returned by Module.__getitem__
+
+	Made once the field is converted and kept in the row in place of
+	its raw column, so every access returns the same one and setting
+	value here changes the row. Anything else is looked up on the
+	field, which is shared by every row of the module.
+	"""
+	__slots__ = ("field", "row", "value")
+
+	def __init__(self, field, row, value):
+		self.field = field
+		self.row = row
+		self.value = value
+
+	@property
+	def pbx(self):
+		return self.row._pbx
+
+	def __getattr__(self, name):
+		if name.startswith("__"): raise AttributeError(name)
+		return getattr(self.field, name)
+
+	def __repr__(self):
+		return self.field.format(self)
 
 class ModuleField():
+	"""Description of one column of a module
+
+	A field holds no row state and is shared by every row: convert
+	turns a column into the value kept in the row, format turns a
+	FieldValue into its wiki text. NULL columns are kept as None
+	without being converted.
+	"""
+	value_class = FieldValue
+
 	def __init__(self, desc = ""):
 		self.description = desc
-		self.value = None
 		self.xpath_location = None
 
-	def populate(self, pbx, val):
-		ret = copy(self)
-		ret.value = val
-		ret.pbx = pbx
-		return ret
+	def convert(self, pbx, val):
+		return val
 
-	def populate_null(self):
-		return copy(self)
-
-	def __repr__(self):
-		return str(self.value)
+	def format(self, v):
+		return str(v.value)
 
 	def xpath(self, path):
 		self.xpath_location = path
 		return self
 
 class IntField(ModuleField):
-	def populate(self, pbx, val):
-		if val == "": return ModuleField.populate_null(self)
-		if val == "disabled": return ModuleField.populate(self, pbx, -666)
-		return ModuleField.populate(self, pbx, int(val))
+	def convert(self, pbx, val):
+		if val == "": return None
+		if val == "disabled": return -666
+		return int(val)
 
-	def __repr__(self):
-		if self.value == -666: return "Disabled"
-		else: return str(self.value)
+	def format(self, v):
+		if v.value == -666: return "Disabled"
+		else: return str(v.value)
 
 class StringField(ModuleField):
-	def populate(self, pbx, val):
+	def convert(self, pbx, val):
 		if isinstance(val, (bytes, bytearray)):
 			val = str(val, "utf-8")
 
-		return ModuleField.populate(self, pbx, val)
-	
-	def __repr__(self):
-		if self.value == None: return ""
-		if len(self.value) == 0: return ""
+		return val
+
+	def format(self, v):
+		if v.value == None: return ""
+		if len(v.value) == 0: return ""
 
-		return ModuleField.__repr__(self)
+		return ModuleField.format(self, v)
 
 class EnumField(ModuleField):
 	def __init__(self, desc, enum):
 		self.enum = enum
 		ModuleField.__init__(self, desc)
 
-	def __repr__(self):
-		return self.enum[self.value]
+	def format(self, v):
+		return self.enum[v.value]
 
 class ListField(ModuleField):
 	def __init__(self, sep, desc = ""):
 		self.separator = sep
 		ModuleField.__init__(self, desc)
 
-	def populate(self, pbx, val):
+	def convert(self, pbx, val):
 		if isinstance(val, (bytes, bytearray)):
 			val = str(val, "utf-8")
-		return ModuleField.populate(self, pbx, val.split(self.separator))
+		return val.split(self.separator)
 
-	def __repr__(self):
-		if self.value is None: return ""
-		return " ".join(self.value)
+	def format(self, v):
+		if v.value is None: return ""
+		return " ".join(v.value)
 
 class BooleanField(ModuleField):
 	def __init__(self, desc = "", tpair = ("", "CHECKED")):
 		self.tpair = tpair
 		ModuleField.__init__(self, desc)
 
-	def populate(self, pbx, val):
-		return ModuleField.populate(self, pbx, val == self.tpair[1])
+	def convert(self, pbx, val):
+		return val == self.tpair[1]
+
+class ForeignKeyValue(FieldValue):
+	__slots__ = ("target",)
+
+	def isref(self):
+		return not self.value in self.field.special
+
+	def attach(self, obj):
+		self.target = obj
+
+	def deref(self):
+		try:
+			return self.target
+		except AttributeError:
+			return self.pbx[self.field.module].get(self.value)
+
+	def __getitem__(self, item):
+		return self.deref()[item]
 
 class ForeignKeyField(ModuleField):
+	value_class = ForeignKeyValue
+
 	def __init__(self, desc, module, special = {}):
 		self.module = module
 		self.special = special
 		ModuleField.__init__(self, desc)
 
-	def populate(self, pbx, val):
-
-		self.pbx = pbx
-		return ModuleField.populate(self, pbx, val)
-
-	def isref(self):
-		return not self.value in self.special
-
-	def deref(self):
-		return self.pbx[self.module].get(self.value)
-
-	def __repr__(self):
-		if self.isref():
+	def format(self, v):
+		if v.isref():
 			try:
-				dr = self.deref()
+				dr = v.deref()
 				return "[[#%s|%s]]" % (dr.uid(), str(dr))
 			except: return "None"
 		else:
-			return self.special[self.value]
-
-	def __getitem__(self, item):
-		return self.deref()[item]
+			return self.special[v.value]
 
 class ManyToManyField(ModuleField):
 	def __init__(self, desc, module, key):
@@ -111,13 +145,14 @@ class ManyToManyField(ModuleField):
 		self.key = key
 		ModuleField.__init__(self, desc)
 
-	def populate(self, pbx, val):
-		children = pbx[self.module].filter(**{self.key: val})
-		return ModuleField.populate(self, pbx, children )
+	def convert(self, pbx, val):
+		return list(pbx[self.module].filter(**{self.key: val}))
 
 
 class DestinationField(ModuleField):
 
+	# the special destinations below are called with the FieldValue
+
 	def blackhole(self, dest):
 		location = {
 			"hangup": "Hangup",
@@ -145,26 +180,36 @@ class DestinationField(ModuleField):
 
 	special_fields = {
 		"app-blackhole,([a-z]+)": blackhole,
-		"app-pbdirectory": lambda x: "Phonebook directory",
+		"app-pbdirectory": lambda self, x: "Phonebook directory",
 		"ext-local,vm([busi][0-9]+)": voicemail,
 		"ext-featurecodes,(\**[0-9]+)": feature_code,
 	}
 
+	special_dispatch = None
+
+	# modules the special destinations above look rows up in
+	special_modules = ("Extension", "FeatureCode")
+
 	def __init__(self, desc = ""):
 		ModuleField.__init__(self, desc)
 
-	def populate(self, pbx, val):
-		return ModuleField.populate(self, pbx, val)
+	@staticmethod
+	def special_match(value):
+		"""Returns the special_fields match of the destination value, or None"""
+		if DestinationField.special_dispatch is None:
+			DestinationField.special_dispatch = PBXUtil.RegexDispatcher(DestinationField.special_fields)
+		return DestinationField.special_dispatch.match(value)
 
-	def __repr__(self):
-		match = PBXUtil.matching_regex( self.special_fields, self.value )
+	def format(self, v):
+		if v.value == None or v.value == "": return ""
+
+		match = self.special_match(v.value)
 		if match is not None:
 			if isinstance(match["key"], str): return match["match"]
-			return match["key"](self, match["match"])
+			return match["key"](v, match["match"])
 
-		d = PBXUtil.dest(self.pbx, self.value)
-		if self.value == None or self.value == "": return ""
-		if isinstance(d, str) or d is None: return OutputFormatter.wiki_error("ERROR: Unknown destination '%s'" % self.value)
+		d = PBXUtil.dest(v.pbx, v.value)
+		if isinstance(d, str) or d is None: return OutputFormatter.wiki_error("ERROR: Unknown destination '%s'" % v.value)
 
 		link_format = "[[#%s|%s: %s]]"
 
@@ -1,11 +1,23 @@
-import requests
-import logging
-import MySQLdb
+import time
+import hashlib
+import threading
 import PBXModule
 
-from lxml.html import fromstring
-from PBXUtil import module
-from sshtunnel import SSHTunnelForwarder
+from concurrent.futures import ThreadPoolExecutor
+from ModuleField import ManyToManyField, DestinationField
+from PBXPool import SQLPool, PBXPoolError
+from PBXCache import RowCache, PageCache, TableSnapshot, DiskPageCache
+from PBXStats import PBXStats
+from PBXCallFlow import CallFlowGraph
+from PBXUtil import module, sanitary_format, normalize_html, dest_resolver, LazyModule, sql_errors, no_such_table
+
+# imported when first connecting or parsing a page
+requests = LazyModule("requests")
+MySQLdb = LazyModule("MySQLdb")
+lxml_html = LazyModule("lxml.html")
+
+def parse_page(content):
+	return lxml_html.fromstring(content)
 
 class PBXError(Exception):
 	pass
@@ -14,7 +26,10 @@ class PBX:
 	"""PBX management class
 	"""
 
-	def __init__(self, url):
+	def __init__(self, url, row_cache_size = 10000, snapshot = False, max_workers = 8,
+			page_cache_dir = None, page_cache_ttl = None, trust_page_cache = False,
+			page_cache_entries = None, page_cache_bytes = 64 * 1024 * 1024,
+			compress_page_cache = False, trace = False, timeout = None):
 		'''Sets up a new PBX instance
 
 		Sets up a new instance of a PBX class. This constructor
@@ -22,6 +37,29 @@ class PBX:
 
 		Args:
 			url: The URL or IP to this PBX
+			row_cache_size: Maximum number of rows (and of filter results)
+				kept in the identity map, or None for no limit
+			snapshot: If True, every module table is read into memory as
+				soon as SQL is connected and all later queries are served
+				from that point-in-time copy
+			max_workers: Number of config pages fetched concurrently by
+				prefetch_pages, and size of the HTTP connection pool
+			page_cache_dir: Directory to keep scraped config pages in across
+				runs, or None to only cache them in memory
+			page_cache_ttl: Seconds a page on disk is used without
+				revalidating it, or None to revalidate it on every use
+			trust_page_cache: If True, pages on disk are always used and
+				can be read without web authentication
+			page_cache_entries: Maximum number of pages kept in memory, or
+				None for no limit
+			page_cache_bytes: Maximum estimated memory of the pages kept in
+				memory (see PageCache.tree_cost), or None for no limit
+			compress_page_cache: Keep pages in memory as compressed HTML and
+				parse them again when used, instead of as parsed trees
+			trace: If True, stats also keeps every SQL statement, page
+				fetch and render as an event for a Chrome trace
+			timeout: Seconds to wait for the web GUI, the SSH tunnel or
+				MySQL to answer before failing, or None to wait forever
 
 		'''
 
@@ -29,14 +67,29 @@ class PBX:
 		self._url = "http://" + url + "/"
 		self._config_base = "admin/config.php"
 
-		self._web_session = requests.Session()
+		self._web_session = None
+		self._max_workers = max_workers
 		self._web_authenticated = False
+		self._timeout = timeout
 
 		self._sql_connected = False
-		self._sql_handle = False
-		self._sql_tunnel = False
+		self._sql_pool = None
+		self._sql_local = threading.local()
+		self._sql_lock = threading.Lock()
+		self._sql_thread_handles = []
+
+		self._page_cache = PageCache(parse_page, page_cache_entries,
+			page_cache_bytes, compress_page_cache)
+		self._disk_cache = None
+		if page_cache_dir is not None:
+			self._disk_cache = DiskPageCache(page_cache_dir, page_cache_ttl, trust_page_cache)
+		self._row_cache = RowCache(row_cache_size)
+
+		self._snapshot_mode = snapshot
+		self._snapshot = None
+		self._call_flow = None
 
-		self._page_cache = {}
+		self.stats = PBXStats(trace)
 
 		self._update_percent = None
 		self._update_status = None
@@ -59,17 +112,27 @@ class PBX:
 		if self._update_percent is not None:
 			self._update_percent(percent)
 
+	def _session( self ):
+		if self._web_session is None:
+			self._web_session = requests.Session()
+			self._web_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize = self._max_workers))
+		return self._web_session
+
 	def connect_web_config( self, username, password ):
 		try:
-			r = self._web_session.get(self._url + self._config_base)
+			r = self._session().get(self._url + self._config_base, timeout = self._timeout)
 		except requests.exceptions.RequestException:
 			raise PBXError("Cannot connect to PBX")
 
 		if r.status_code == 404:
 			raise PBXError("Configuration page not found")
 
-		self._web_session.auth = ( username, password )
-		r = self._web_session.post(self._url + self._config_base, data = {"username": username, "password": password})
+		self._session().auth = ( username, password )
+		try:
+			r = self._session().post(self._url + self._config_base,
+				data = {"username": username, "password": password}, timeout = self._timeout)
+		except requests.exceptions.RequestException:
+			raise PBXError("Cannot log in to PBX")
 
 		if r.status_code == 401 or b"Invalid Username or Password" in r.content:
 			raise PBXError("Invalid username or password")
@@ -77,83 +140,449 @@ class PBX:
 		self._web_authenticated = True
 
 	def connect_sql( self, username, password ):
-		ssh_logger = logging.getLogger("ssh-logger")
-		ssh_logger.disabled = True
+		if self._sql_pool is not None: PBX.close(self)
 
 		self.update_subtask("Opening proxy")
-		self._sql_tunnel = SSHTunnelForwarder(
-					(self._base_url, 22),
-					ssh_username=username,
-					ssh_password=password,
-					remote_bind_address=('localhost', 3306),
-					logger = ssh_logger)
+		self._sql_pool = SQLPool.for_host(self._base_url, username, password, self._max_workers, self._timeout)
 
-		self._sql_tunnel.start()
-		self._sql_handle = None
-		#if not self._sql_tunnel.is_active:
-		#	raise PBXError("Cannot open SSH tunnel")
+		self.update_subtask("Logging in")
+		self._sql_connection()
+		self._sql_connected = True
+		self.update_subtask("Logged in")
 
+		if self._snapshot_mode:
+			self.load_snapshot()
 
-		self.update_subtask("Logging in")
-		try:
-			self._sql_handle = MySQLdb.connect(
-				'127.0.0.1',
-				'root',
-				password,
-				'asterisk', self._sql_tunnel.local_bind_port);
-		except:
+	def _sql_connection( self ):
+		# MySQLdb connections must not be shared between threads, so
+		# every thread takes its own from the pool and keeps it until
+		# release_sql or close
+		handle = getattr(self._sql_local, "handle", None)
+		if handle is None:
 			try:
-				self._sql_handle = MySQLdb.connect(
-					'127.0.0.1',
-					'root',
-					'',
-					'asterisk', self._sql_tunnel.local_bind_port);
-			except:
-				raise PBXError("Cannot log in to SQL")
-		self.update_subtask("Logged in")
+				handle = self._sql_pool.acquire()
+			except PBXPoolError as e:
+				raise PBXError(str(e))
+
+			self._sql_local.handle = handle
+			with self._sql_lock:
+				self._sql_thread_handles.append(handle)
+		return handle
+
+	def release_sql( self, broken = False ):
+		'''Returns the calling thread's SQL connection to the pool
+
+		With broken set the connection is closed instead, after an error
+		on it, and the thread's next query opens a new one.
+		'''
+		handle = getattr(self._sql_local, "handle", None)
+		if handle is None: return
+
+		self._sql_local.handle = None
+		with self._sql_lock:
+			self._sql_thread_handles.remove(handle)
+		if broken: self._sql_pool.discard(handle)
+		else: self._sql_pool.release(handle)
+
+	def sql_pool_stats( self ):
+		if self._sql_pool is None: return None
+		return self._sql_pool.stats()
 
 	def get_sql_cursor( self ):
-		if not self._sql_handle: raise PBXError()
-		return self._sql_handle.cursor(MySQLdb.cursors.DictCursor)
+		if not self._sql_connected: raise PBXError()
+		return self._sql_connection().cursor(MySQLdb.cursors.DictCursor)
+
+	def iter_sql( self, q, params = None, batch_size = 500, source = ("PBX", "iter_sql"), key = None ):
+		'''Yields the rows of the SELECT q as lists of up to batch_size dicts
+
+		Without a key, q is run once and its buffered rows are handed out
+		a batch at a time. key names a column unique among the rows of q;
+		each batch is then read with a query of its own that resumes after
+		the last key of the one before, so only one batch is held in
+		memory at a time and the rows come ordered by key. q must then
+		have no WHERE, ORDER BY or LIMIT of its own. The rows are read
+		over the calling thread's connection rather than another from the
+		pool, which queries made while consuming them can use in between.
+		Every query is recorded in stats under the (module, method) source.
+
+		'''
+		params = list(params or [])
+
+		if key is None:
+			cur = self.stats.cursor(self.get_sql_cursor(), *source)
+			cur.execute(q, params)
+			while True:
+				rows = cur.fetchmany(batch_size)
+				if len(rows) == 0: break
+				yield rows
+			return
+
+		q = q.rstrip().rstrip(";")
+		first = q + sanitary_format(" ORDER BY {key} LIMIT %s;", key = key)
+		after = q + sanitary_format(" WHERE {key} > %s ORDER BY {key} LIMIT %s;", key = key)
+
+		last = None
+		while True:
+			cur = self.stats.cursor(self.get_sql_cursor(), *source)
+			if last is None: cur.execute(first, params + [batch_size])
+			else: cur.execute(after, params + [last, batch_size])
+			rows = cur.fetchall()
+			if len(rows): yield rows
+			if len(rows) < batch_size: break
+			last = rows[-1][key]
+
+	def load_snapshot(self):
+		'''Reads every registered module's table into memory
+
+		Issues one SELECT per db_table inside a consistent-snapshot
+		transaction and indexes the rows by primary key and by every
+		field a ManyToManyField looks children up with. Tables missing
+		from this PBX are loaded as empty; any other error is raised.
+
+		'''
+		self.update_status("Loading configuration snapshot")
+		self._snapshot = self._read_tables(self.snapshot_modules())
+		self._call_flow = None
+
+	def _read_tables(self, classes):
+		cur = self.stats.cursor(self.get_sql_cursor(), "PBX", "load_snapshot")
+		cur.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT;")
+
+		snapshot = {}
+		for cls in classes:
+			self.update_subtask("\tLoading table: " + cls.db_table)
+			try:
+				cur.execute(sanitary_format("SELECT * FROM {table};", table = cls.db_table))
+				rows = cur.fetchall()
+			except sql_errors() as e:
+				if not no_such_table(e): raise
+				rows = []
+
+			snapshot[cls] = self.make_table_snapshot(cls, rows)
+
+		cur.execute("COMMIT;")
+		return snapshot
+
+	def reload_tables(self, classes):
+		'''Reads the tables of classes into the snapshot again
+
+		The config pages of their old and new rows are dropped from the
+		page caches, and every cached row is invalidated, as rows of
+		other modules may hold references to the reloaded ones.
+
+		'''
+		if self._snapshot is None: raise PBXError("Not in snapshot mode")
+
+		tables = self._read_tables(classes)
+		for cls, snap in tables.items():
+			old = self._snapshot.get(cls)
+			rows = snap.rows if old is None else old.rows + snap.rows
+			self.drop_pages(self[cls.__name__].page_params(rows))
+
+		self._snapshot.update(tables)
+		self._row_cache.invalidate()
+		self._call_flow = None
+
+	def table_checksums(self, classes = None):
+		'''Returns a checksum of the table of every class in classes
+
+		Uses CHECKSUM TABLE, falling back to a hash of the rows of tables
+		the server cannot checksum. Tables missing from this PBX have a
+		checksum of None.
+
+		Args:
+			classes: Module classes to checksum, every module with a
+				db_table if None
+
+		'''
+		if classes is None: classes = self.snapshot_modules()
+		tables = sorted(set([cls.db_table for cls in classes]))
+		cur = self.stats.cursor(self.get_sql_cursor(), "PBX", "checksum")
+
+		sums = {}
+		try:
+			cur.execute(sanitary_format("CHECKSUM TABLE {tables};", tables = ",".join(tables)))
+			for row in cur.fetchall():
+				sums[row["Table"].split(".")[-1]] = row["Checksum"]
+		except sql_errors():
+			pass
+
+		for table in tables:
+			if table not in sums: sums[table] = self._hash_table(cur, table)
+
+		return dict([(cls, sums[cls.db_table]) for cls in classes])
+
+	def page_checksums(self, classes):
+		'''Returns a checksum of the config pages of the rows of every class
+
+		The pages are dropped from the page caches and fetched again
+		first, so a change made only on a page, such as the members of a
+		queue, changes the checksum of its class. Rows are those of the
+		snapshot.
+
+		'''
+		if self._snapshot is None: raise PBXError("Not in snapshot mode")
+
+		sums = {}
+		for cls in classes:
+			snap = self.snapshot_table(cls)
+			params = self[cls.__name__].page_params([] if snap is None else snap.rows)
+			self.drop_pages(params)
+			self.prefetch_pages(params)
+
+			h = hashlib.sha1()
+			for p in params:
+				h.update(lxml_html.tostring(self.get_config_from_param(**p)))
+			sums[cls] = h.hexdigest()
+		return sums
+
+	@staticmethod
+	def _hash_table(cur, table):
+		try:
+			cur.execute(sanitary_format("SELECT * FROM {table};", table = table))
+			rows = cur.fetchall()
+		except sql_errors() as e:
+			if not no_such_table(e): raise
+			return None
+
+		rows = sorted([repr(sorted(row.items())) for row in rows])
+		return hashlib.sha1("\n".join(rows).encode("utf-8")).hexdigest()
+
+	def dependent_modules(self, classes):
+		'''Returns the module classes whose rendering shows rows of classes
+
+		See ModuleGraph.invalidated_by. Destination edges are only
+		followed from modules whose snapshot rows hold a destination
+		into one of classes. classes themselves are not included.
+
+		'''
+		resolver = dest_resolver()
+
+		def refers(name, target):
+			cls = module.registry[name]
+			snap = self.snapshot_table(cls)
+			if target in DestinationField.special_modules or snap is None: return True
+
+			fields = [k for k, f in cls.fields.items() if isinstance(f, DestinationField)]
+			for row in snap.rows:
+				for k in fields:
+					match = resolver.match(str(row.get(k)))
+					if match is not None and match["key"] == target: return True
+			return False
+
+		names = module.graph.invalidated_by([cls.__name__ for cls in classes], refers)
+		return [module.registry[n] for n in names]
+
+	@staticmethod
+	def snapshot_modules():
+		# referenced tables first, see ModuleGraph.load_order
+		return [module.registry[n] for n in module.graph.load_order()
+			if hasattr(module.registry[n], "db_table")]
+
+	@staticmethod
+	def make_table_snapshot(cls, rows):
+		fields = set([cls.pk_field])
+		for other in module.registry.values():
+			for f in other.fields.values():
+				if isinstance(f, ManyToManyField) and f.module == cls.__name__:
+					fields.add(f.key)
+
+		return TableSnapshot(rows, sorted(fields))
+
+	def drop_snapshot(self):
+		self._snapshot = None
+		self._call_flow = None
+
+	def snapshot_table(self, cls):
+		if self._snapshot is None: return None
+		return self._snapshot.get(cls)
 
 	def make_config_url(self, param):
-		get_line = "?"
-		for k, v in param.items():
-			get_line += "%s=%s&" % (k, v)
-		return self._url + self._config_base + get_line
+		return self._url + self.config_path(param)
+
+	def get_config_url(self, url, pin = False):
+		page = self._page_cache.get(url)
+		if page is not None:
+			self.stats.page_hit(url)
+			return page
+
+		start = time.perf_counter()
+		try:
+			content = self._fetch_page(url)
+		finally:
+			self.stats.page_miss(url, start, time.perf_counter() - start)
+		return self._page_cache.put(url, content, pin)
+
+	def _fetch_page(self, url):
+		cached, meta, headers = self._disk_lookup(url)
+		if cached is not None and meta is None: return cached
+
+		try:
+			r = self._session().get(self._url + url, headers=headers, timeout = self._timeout)
+		except requests.exceptions.Timeout:
+			raise PBXError("Timed out fetching " + url)
+		except requests.exceptions.RequestException as e:
+			raise PBXError("Cannot fetch %s: %s" % (url, e))
+		return self._scraped_page(url, r.status_code, r.content, r.headers, cached, meta)
+
+	def _disk_lookup(self, url):
+		# Returns (content, None, None) for a page that can be used as is,
+		# or the cached (content, meta) and the headers to fetch it with
+		headers = {'referer': self._config_base}
+
+		cached = meta = None
+		disk = self._disk_cache
+		if disk is not None:
+			cached, meta, fresh = disk.lookup(self._base_url, url)
+			if fresh: return cached, None, None
+			if cached is not None: headers.update(disk.validators(meta))
 
-	def get_config_url(self, url):
 		if not self._web_authenticated:
 			raise PBXError("could not web auth")
 
-		if url in self._page_cache:
-			return self._page_cache[url]
-
 		self.update_subtask("\tScraping: " + url.split("?")[1])
-		r = self._web_session.get(self._url + url, headers={'referer': self._config_base})
+		return cached, meta, headers
 
-		if r.status_code != 200:
-			raise PBXError("Config scrape error: " + str(r.status_code))
+	def _scraped_page(self, url, status, content, headers, cached, meta):
+		disk = self._disk_cache
+		if status == 304 and disk is not None and cached is not None:
+			disk.not_modified(self._base_url, url, meta)
+			return cached
 
-		t = r.content
+		if status != 200:
+			raise PBXError("Config scrape error: " + str(status))
 
-		t = t.replace(b'"CHECKED ', b'" CHECKED ')
-		t = t.replace(b' CHECKED ', b' CHECKED="checked" ')
-		t = t.replace(b"CHECKED", b"checked")
+		t = normalize_html(content)
 
-		t = t.replace(b'"SELECTED', b'" SELECTED')
-		t = t.replace(b'SELECTED', b' SELECTED="selected" ')
-		t = t.replace(b"SELECTED", b"selected")
+		if disk is not None:
+			disk.store(self._base_url, url, t, headers)
 
-		self._page_cache[url] = fromstring(t)
+		return t
 
-		return self._page_cache[url]
-
-	def get_config_from_param( self, **kwargs ):
+	def config_path(self, param):
 		get_line = "?"
-		for k, v in kwargs.items():
+		for k, v in param.items():
 			get_line += "%s=%s&" % (k, v)
-		return self.get_config_url(self._config_base + get_line)
+		return self._config_base + get_line
+
+	def drop_pages(self, params_list):
+		'''Removes the config pages for params_list from the page caches'''
+		for p in params_list:
+			url = self.config_path(p)
+			self._page_cache.discard(url)
+			if self._disk_cache is not None:
+				self._disk_cache.discard(self._base_url, url)
+
+	def get_config_from_param( self, **kwargs ):
+		return self.get_config_url(self.config_path(kwargs))
+
+	def prefetch_pages(self, params_list, max_workers = None):
+		'''Fetches config pages concurrently into the page cache
+
+		Pages that are already cached are skipped. The pages are fetched
+		in rounds of max_workers, while the page cache has room, and
+		kept in it ahead of pages already read; the rest are left to be
+		fetched when requested, so prefetching never goes over the
+		cache's budget. Failed fetches are ignored here; they raise
+		again when the page is requested.
+
+		Args:
+			params_list: Iterable of parameter dicts, as passed to
+				get_config_from_param
+			max_workers: Number of concurrent fetches, defaults to the
+				max_workers given to the constructor
+
+		'''
+		urls = []
+		for p in params_list:
+			url = self.config_path(p)
+			if url not in self._page_cache and url not in urls: urls.append(url)
+
+		if len(urls) == 0: return
+		workers = min(max_workers or self._max_workers, len(urls))
+
+		def fetch(url):
+			try:
+				self.get_config_url(url, True)
+			except PBXError:
+				pass
+
+		with ThreadPoolExecutor(workers) as pool:
+			for i in range(0, len(urls), workers):
+				if not self._page_cache.has_room(): break
+				list(pool.map(fetch, urls[i:i + workers]))
+
+	def prewarm(self, classes = None):
+		'''Fetches the config pages of classes and of the modules they refer to
+
+		The pages are fetched by prefetch_pages, as many as the page
+		cache has room for, those of referenced modules first (see
+		ModuleGraph.load_order).
+		Rows are read from the snapshot, so outside snapshot mode only
+		the pages of modules without a table are fetched.
+
+		Args:
+			classes: Module classes to prewarm, every module if None
+
+		'''
+		graph = module.graph
+		if classes is None: names = graph.names()
+		else:
+			names = []
+			for cls in classes:
+				for n in [cls.__name__] + graph.closure(cls.__name__):
+					if n not in names: names.append(n)
+
+		params = []
+		for n in graph.load_order(names):
+			m = self[n]
+			if not hasattr(m, "db_table"): params += m.page_params([])
+			elif self.snapshot_table(m.__class__) is not None:
+				params += m.page_params(self.snapshot_table(m.__class__).rows)
+
+		self.prefetch_pages(params)
+
+	def cached_row(self, cls, pk):
+		return self._row_cache.get(cls, pk)
+
+	def cache_row(self, cls, pk, obj):
+		self._row_cache.put(cls, pk, obj)
+
+	def cached_query(self, cls, kwargs):
+		return self._row_cache.get_query(cls, kwargs)
+
+	def cache_query(self, cls, kwargs, result):
+		self._row_cache.put_query(cls, kwargs, result)
+
+	def invalidate(self, mod = None, pk = None):
+		'''Drops rows from the identity map
+
+		Args:
+			mod: Module name or class to invalidate, or None for every module
+			pk: Primary key of the single row to invalidate, or None for
+				every row of mod
+
+		'''
+		if isinstance(mod, str): mod = module.registry[mod]
+		self._row_cache.invalidate(mod, pk)
+		self._call_flow = None
+
+	def call_flow(self):
+		'''Returns the CallFlowGraph of every destination on this PBX
+
+		It is built on first use and kept until the snapshot is loaded,
+		reloaded or dropped, or rows are invalidated.
+		'''
+		if self._call_flow is None:
+			self._call_flow = CallFlowGraph(self)
+		return self._call_flow
+
+	def cache_stats(self):
+		stats = self._row_cache.stats()
+		stats["pages"] = self._page_cache.stats()
+		if self._disk_cache is not None:
+			stats["disk_pages"] = self._disk_cache.stats()
+		return stats
 
 	def __getitem__(self, mod):
 		return module(self, name=mod)
@@ -163,10 +592,30 @@ class PBX:
 			yield self[m]
 
 	def __del__(self):
-		self._sql_tunnel.stop()
+		# PBX.close explicitly, subclasses may make close a coroutine;
+		# a constructor that failed early leaves nothing to close
+		if hasattr(self, "_sql_lock"): PBX.close(self)
 
 	def close(self):
-		self._sql_tunnel.stop()
+		'''Hands every SQL connection back to the pool and detaches from it
+
+		The SSH tunnel and the idle connections stay open for the next PBX
+		instance for the same host and credentials, until the pool has
+		been unused for SQLPool.idle_timeout or SQLPool.close_all runs at
+		exit; see PBXPool.SQLPool.close_idle.
+		'''
+		with self._sql_lock:
+			handles = self._sql_thread_handles
+			self._sql_thread_handles = []
+			self._sql_local = threading.local()
+			pool = self._sql_pool
+			self._sql_pool = None
+			self._sql_connected = False
+
+		if pool is None: return
+		for handle in handles:
+			pool.release(handle)
+		pool.detach()
 
 	@staticmethod
 	def get_module_names():
@@ -0,0 +1,442 @@
+import os
+import re
+import zlib
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict as ODict
+
+class LRUCache:
+	"""Least recently used mapping bounded by entries and/or size
+
+	Each entry is put with a size (0 if not given) and the least
+	recently used entries are evicted while either max_entries or
+	max_bytes is exceeded; None leaves that bound off. An entry put
+	pinned is evicted only once no unpinned entry is left, until it is
+	first read; the bounds hold either way. All operations take an internal lock, so a cache may be shared
+	between threads.
+	"""
+
+	def __init__(self, max_entries = None, max_bytes = None):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self._entries = ODict()
+		self._pinned = set()
+		self._lock = threading.RLock()
+
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key, default = None):
+		with self._lock:
+			if key not in self._entries:
+				self.misses += 1
+				return default
+
+			self.hits += 1
+			self._pinned.discard(key)
+			self._entries.move_to_end(key)
+			return self._entries[key][0]
+
+	def put(self, key, value, size = 0, pin = False):
+		with self._lock:
+			if key in self._entries:
+				self.bytes -= self._entries[key][1]
+			self._entries[key] = (value, size)
+			self._entries.move_to_end(key)
+			self.bytes += size
+			if pin: self._pinned.add(key)
+			else: self._pinned.discard(key)
+			self._evict()
+
+	def pop(self, key, default = None):
+		with self._lock:
+			if key not in self._entries: return default
+			value, size = self._entries.pop(key)
+			self._pinned.discard(key)
+			self.bytes -= size
+			return value
+
+	def remove_if(self, predicate):
+		with self._lock:
+			for k in [k for k in self._entries if predicate(k)]:
+				self.pop(k)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._pinned.clear()
+			self.bytes = 0
+
+	def _over(self):
+		return (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+			(self.max_bytes is not None and self.bytes > self.max_bytes)
+
+	def has_room(self):
+		"""True if an entry can be added without evicting another"""
+		with self._lock:
+			return (self.max_entries is None or len(self._entries) < self.max_entries) and \
+				(self.max_bytes is None or self.bytes < self.max_bytes)
+
+	def _evict(self):
+		if not self._over(): return
+		for pinned in (False, True):
+			for key in list(self._entries):
+				if not self._over(): return
+				if (key in self._pinned) != pinned: continue
+				value, size = self._entries.pop(key)
+				self._pinned.discard(key)
+				self.bytes -= size
+				self.evictions += 1
+
+	def hit_ratio(self):
+		total = self.hits + self.misses
+		if total == 0: return 0.0
+		return self.hits / total
+
+	def stats(self):
+		return {
+			"entries": len(self._entries),
+			"bytes": self.bytes,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"pinned": len(self._pinned),
+			"hit_ratio": self.hit_ratio(),
+		}
+
+	def __contains__(self, key):
+		with self._lock:
+			return key in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+class RowCache:
+	"""Identity map of module rows, keyed by (module class, pk)
+
+	Rows are stored by Module.from_row and read back by Module.get, so
+	every row is only read from the database once. Results of
+	Module.filter are kept alongside, keyed by the filter arguments.
+	"""
+
+	def __init__(self, max_rows = None):
+		self._rows = LRUCache(max_rows)
+		self._queries = LRUCache(max_rows)
+
+	@staticmethod
+	def _key(cls, pk):
+		return (cls, str(pk))
+
+	def get(self, cls, pk):
+		return self._rows.get(self._key(cls, pk))
+
+	def put(self, cls, pk, obj):
+		self._rows.put(self._key(cls, pk), obj)
+
+	def get_query(self, cls, kwargs):
+		return self._queries.get((cls, self._query_key(kwargs)))
+
+	def put_query(self, cls, kwargs, result):
+		self._queries.put((cls, self._query_key(kwargs)), result)
+
+	@staticmethod
+	def _query_key(kwargs):
+		return tuple(sorted([(k, str(v)) for k, v in kwargs.items()]))
+
+	def invalidate(self, cls = None, pk = None):
+		if cls is None:
+			self._rows.clear()
+			self._queries.clear()
+		elif pk is None:
+			self._rows.remove_if(lambda k: k[0] is cls)
+			self._queries.remove_if(lambda k: k[0] is cls)
+		else:
+			# any cached filter result may contain the row
+			self._rows.pop(self._key(cls, pk))
+			self._queries.remove_if(lambda k: k[0] is cls)
+
+	def stats(self):
+		return {"rows": self._rows.stats(), "queries": self._queries.stats()}
+
+class PageCache:
+	"""Bounded in-memory cache of scraped config pages
+
+	Pages are kept as parsed trees, or with compress set as zlib
+	compressed HTML that is parsed again on every hit. A tree is
+	accounted by tree_cost, an estimate of the memory lxml takes for
+	it, and compressed HTML by its length. Pages put pinned, such as a
+	prefetched batch, are evicted after the others until first read.
+	"""
+
+	# bytes lxml takes per tag of the HTML, measured on config pages
+	tag_bytes = 256
+
+	def __init__(self, parse, max_entries = None, max_bytes = None, compress = False):
+		self._parse = parse
+		self._lru = LRUCache(max_entries, max_bytes)
+		self.compress = compress
+
+	def get(self, url):
+		entry = self._lru.get(url)
+		if entry is None or not self.compress: return entry
+		return self._parse(zlib.decompress(entry))
+
+	@classmethod
+	def tree_cost(cls, content):
+		"""Estimated memory of the parsed tree of the HTML content"""
+		return len(content) + cls.tag_bytes * content.count(b"<")
+
+	def put(self, url, content, pin = False):
+		"""Caches the normalized HTML of a page, returns its parsed tree"""
+		tree = self._parse(content)
+		if self.compress:
+			data = zlib.compress(content)
+			self._lru.put(url, data, len(data), pin)
+		else:
+			self._lru.put(url, tree, self.tree_cost(content), pin)
+		return tree
+
+	def discard(self, url):
+		self._lru.pop(url)
+
+	def has_room(self):
+		return self._lru.has_room()
+
+	def clear(self):
+		self._lru.clear()
+
+	def stats(self):
+		return self._lru.stats()
+
+	def __contains__(self, url):
+		return url in self._lru
+
+	def __len__(self):
+		return len(self._lru)
+
+class TableSnapshot:
+	"""In-memory copy of one database table
+
+	Holds the raw rows of a table as returned by a DictCursor, with
+	hash indexes on the given fields. get, filter and ordered mimic
+	the SQL the modules would otherwise run against MySQL.
+	"""
+
+	operands = {
+		"eq": lambda a, b: a == b,
+		"neq": lambda a, b: a != b,
+		"lt": lambda a, b: a < b,
+		"lte": lambda a, b: a <= b,
+		"gt": lambda a, b: a > b,
+		"gte": lambda a, b: a >= b,
+	}
+
+	def __init__(self, rows, index_fields = ()):
+		self.rows = list(rows)
+		self._indexes = {}
+		for f in index_fields:
+			index = {}
+			for row in self.rows:
+				if f in row:
+					index.setdefault(self._index_key(row[f]), []).append(row)
+			self._indexes[f] = index
+
+	@staticmethod
+	def _text(v):
+		if isinstance(v, (bytes, bytearray)):
+			return str(v, "utf-8", "replace")
+		return str(v)
+
+	@classmethod
+	def _index_key(cls, v):
+		# MySQL compares with a case insensitive collation
+		return cls._text(v).lower()
+
+	@classmethod
+	def _comparable(cls, raw, value):
+		if isinstance(raw, (int, float)) and not isinstance(raw, bool):
+			try: return raw, float(value)
+			except (TypeError, ValueError): pass
+		return cls._index_key(raw), cls._index_key(value)
+
+	@classmethod
+	def _match(cls, row, field, op, value):
+		raw = row.get(field)
+		if raw is None: return False
+
+		if op == "in":
+			return any([cls._match(row, field, "eq", v) for v in value])
+
+		if op == "like":
+			pattern = re.escape(cls._index_key(value)).replace("%", ".*").replace("_", ".")
+			return re.fullmatch(pattern, cls._index_key(raw), re.S) is not None
+
+		a, b = cls._comparable(raw, value)
+		try: return cls.operands[op](a, b)
+		except TypeError: return False
+
+	def get(self, field, value):
+		rows = self.lookup(field, value)
+		if len(rows): return rows[0]
+		return None
+
+	def lookup(self, field, value):
+		if field in self._indexes:
+			return self._indexes[field].get(self._index_key(value), [])
+		return [r for r in self.rows if self._match(r, field, "eq", value)]
+
+	def filter(self, conditions):
+		"""Returns the rows matching every (field, op, value) condition"""
+		rows = self.rows
+		for field, op, value in conditions:
+			if op == "eq" and field in self._indexes:
+				rows = self.lookup(field, value)
+				break
+			if op == "in" and field in self._indexes:
+				found = {}
+				for v in value:
+					for r in self.lookup(field, v): found[id(r)] = r
+				rows = list(found.values())
+				break
+
+		for field, op, value in conditions:
+			rows = [r for r in rows if self._match(r, field, op, value)]
+		return rows
+
+	@classmethod
+	def _sort_key(cls, v):
+		if v is None: return (0, 0, "")
+		if isinstance(v, (int, float)): return (1, v, "")
+		return (2, 0, cls._index_key(v))
+
+	@classmethod
+	def ordered(cls, rows, order_str):
+		"""Sorts rows by an ordering string such as "modulename,description-" """
+		rows = list(rows)
+		for f in reversed(order_str.split(",")):
+			f = f.strip()
+			reverse = f[-1] == "-"
+			if f[-1] in "+-": f = f[:-1]
+			rows.sort(key = lambda r: cls._sort_key(r.get(f)), reverse = reverse)
+		return rows
+
+	def __len__(self):
+		return len(self.rows)
+
+class DiskPageCache:
+	"""Persistent cache of normalized config pages
+
+	Pages are stored under directory, keyed by host and URL, as the
+	normalized HTML plus a JSON metadata file holding the content hash,
+	fetch time and any HTTP validators the server sent.
+
+	An entry younger than ttl seconds is served without contacting the
+	PBX. Older entries, and every entry if ttl is None, are revalidated
+	with a conditional request. With trust set, every cached entry is
+	used regardless of age, which allows working offline.
+	"""
+
+	def __init__(self, directory, ttl = None, trust = False):
+		self.directory = directory
+		self.ttl = ttl
+		self.trust = trust
+		os.makedirs(directory, exist_ok = True)
+
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.stale = 0
+		self.revalidated = 0
+
+	def _path(self, host, url):
+		key = hashlib.sha1(("%s\n%s" % (host, url)).encode("utf-8")).hexdigest()
+		return os.path.join(self.directory, key)
+
+	def _count(self, counter):
+		with self._lock:
+			setattr(self, counter, getattr(self, counter) + 1)
+
+	def lookup(self, host, url):
+		"""Returns (content, meta, fresh), content being None on a miss"""
+		path = self._path(host, url)
+		try:
+			with open(path + ".json") as f: meta = json.load(f)
+			with open(path + ".html", "rb") as f: content = f.read()
+		except (OSError, ValueError):
+			self._count("misses")
+			return None, None, False
+
+		if hashlib.sha1(content).hexdigest() != meta.get("sha1"):
+			self._count("misses")
+			return None, None, False
+
+		fresh = self.trust or (self.ttl is not None and time.time() - meta["fetched"] < self.ttl)
+		self._count("hits" if fresh else "stale")
+		return content, meta, fresh
+
+	@staticmethod
+	def validators(meta):
+		headers = {}
+		if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+		if meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+		return headers
+
+	def store(self, host, url, content, headers = {}):
+		"""Writes a freshly fetched page, returns True if it was unchanged"""
+		digest = hashlib.sha1(content).hexdigest()
+		path = self._path(host, url)
+
+		unchanged = False
+		try:
+			with open(path + ".json") as f:
+				unchanged = json.load(f).get("sha1") == digest
+		except (OSError, ValueError):
+			pass
+
+		if not unchanged:
+			self._write(path + ".html", content)
+		self.touch(host, url, digest, headers)
+		if unchanged: self._count("revalidated")
+		return unchanged
+
+	def touch(self, host, url, digest, headers = {}):
+		meta = {
+			"host": host,
+			"url": url,
+			"sha1": digest,
+			"fetched": time.time(),
+			"etag": headers.get("ETag"),
+			"last_modified": headers.get("Last-Modified"),
+		}
+		self._write(self._path(host, url) + ".json", json.dumps(meta).encode("utf-8"))
+
+	def not_modified(self, host, url, meta):
+		self.touch(host, url, meta["sha1"], {"ETag": meta.get("etag"),
+			"Last-Modified": meta.get("last_modified")})
+		self._count("revalidated")
+
+	def discard(self, host, url):
+		path = self._path(host, url)
+		for ext in (".json", ".html"):
+			try:
+				os.remove(path + ext)
+			except OSError:
+				pass
+
+	@staticmethod
+	def _write(path, data):
+		tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+		with open(tmp, "wb") as f: f.write(data)
+		os.replace(tmp, path)
+
+	def stats(self):
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"stale": self.stale,
+			"revalidated": self.revalidated,
+		}
@@ -0,0 +1,249 @@
+from collections import OrderedDict as ODict
+from ModuleField import DestinationField, ManyToManyField
+from PBXUtil import module, dest_resolver, sql_errors, no_such_table
+
+class CallFlowGraph:
+	"""Directed graph of every destination of a PBX, built in one pass
+
+	Nodes are (module name, primary key) pairs, the key as a string, for
+	every row of the modules that have a DestinationField or can be a
+	destination (a dest_regex). Each DestinationField value is an edge
+	labelled with the field name; the destinations of child rows, such
+	as IVR entries, are edges of their parent labelled with the
+	ManyToManyField, the child's position and its field, as in
+	"entries[2].dest". Special destinations (hangup, voicemail, feature
+	codes...) lead to terminal nodes ("", destination), and
+	destinations naming no row are kept in dangling instead.
+
+	Only the raw columns of those tables are read, with one query per
+	table, or none in snapshot mode. The graph does not follow changes
+	to the PBX; PBX.call_flow keeps one until tables are reloaded.
+
+		flow = pbx.call_flow()
+		for path in flow.paths(flow.did("5551234")): print(path)
+	"""
+
+	def __init__(self, pbx):
+		self._pbx = pbx
+		self.nodes = ODict()
+		self.edges = {}
+		self.dangling = []
+		self._reach = {}
+		self._cycles = None
+		self._build()
+
+	@staticmethod
+	def _dest_fields(cls):
+		return [k for k, f in cls.fields.items() if isinstance(f, DestinationField)]
+
+	def _rows(self, cls, fields):
+		# a module whose table this PBX lacks has no rows; any other error
+		# would leave the graph incomplete, and so is raised
+		try:
+			return list(self._pbx[cls.__name__].query().values(*fields))
+		except sql_errors() as e:
+			if no_such_table(e): return []
+			raise
+
+	def _build(self):
+		registry = module.registry
+		children = {}
+		for cls in registry.values():
+			for name, f in cls.fields.items():
+				if isinstance(f, ManyToManyField) and len(self._dest_fields(registry[f.module])):
+					children.setdefault(cls.__name__, []).append((name, f))
+
+		owned = set([f.module for fs in children.values() for name, f in fs])
+		sources = []
+		for cls in registry.values():
+			if not hasattr(cls, "db_table") or cls.__name__ in owned: continue
+			dests = self._dest_fields(cls)
+			if not (len(dests) or cls.__name__ in children or hasattr(cls, "dest_regex")): continue
+
+			rows = self._rows(cls, [cls.pk_field] + dests)
+			for row in rows:
+				self.nodes[(cls.__name__, str(row[cls.pk_field]))] = None
+			sources.append((cls, dests, rows))
+
+		child_rows = {}
+		for name in owned:
+			cls = registry[name]
+			child_rows[name] = self._rows(cls, list(ODict.fromkeys(
+				[f.key for fs in children.values() for n, f in fs if f.module == name] + self._dest_fields(cls))))
+
+		for key in self.nodes: self.edges[key] = []
+		for cls, dests, rows in sources:
+			by_parent = {}
+			for m2m, f in children.get(cls.__name__, []):
+				found = {}
+				for child in child_rows[f.module]:
+					found.setdefault(str(child[f.key]), []).append(child)
+				by_parent[m2m] = (found, self._dest_fields(registry[f.module]))
+
+			for row in rows:
+				key = (cls.__name__, str(row[cls.pk_field]))
+				for k in dests: self._add(key, k, row[k])
+				for m2m, (found, fields) in by_parent.items():
+					for i, child in enumerate(found.get(key[1], [])):
+						for k in fields: self._add(key, "%s[%d].%s" % (m2m, i + 1, k), child[k])
+
+	def _add(self, key, label, destination):
+		if destination is None or destination == "": return
+		if isinstance(destination, (bytes, bytearray)): destination = str(destination, "utf-8")
+
+		if DestinationField.special_match(destination) is not None:
+			target = ("", destination)
+			self.nodes.setdefault(target, None)
+			self.edges.setdefault(target, [])
+		else:
+			match = dest_resolver().match(destination)
+			target = None if match is None else (match["key"], str(match["match"]))
+			if target not in self.nodes:
+				self.dangling.append((key, label, destination))
+				return
+
+		self.edges[key].append((label, target))
+
+	@staticmethod
+	def did(number):
+		"""Returns the node of the inbound route for the DID number"""
+		return ("InboundRoute", str(number))
+
+	def entry_points(self):
+		"""Nodes calls can start from: rows of modules that are not a destination"""
+		return [k for k in self.nodes if k[0] != "" and not hasattr(module.registry[k[0]], "dest_regex")]
+
+	def successors(self, key):
+		return [t for label, t in self.edges.get(key, [])]
+
+	def reachable(self, key):
+		"""Returns every node reached from key, key first, in breadth first order
+
+		Computed once per node, in time linear in the size of the result.
+		"""
+		if key in self._reach: return self._reach[key]
+		if key not in self.nodes: raise KeyError(key)
+
+		order = [key]
+		seen = set(order)
+		i = 0
+		while i < len(order):
+			for t in self.successors(order[i]):
+				if t not in seen:
+					seen.add(t)
+					order.append(t)
+			i += 1
+
+		self._reach[key] = order
+		return order
+
+	def flow(self, key):
+		"""Returns the (source, label, target) edges of every path from key
+
+		Together they describe every path, in time linear in the part of
+		the graph reached rather than in the number of paths.
+		"""
+		return [(n, label, t) for n in self.reachable(key) for label, t in self.edges[n]]
+
+	def paths(self, key, limit = None):
+		"""Yields every path from key as a list of (label, node) hops
+
+		A path ends at a node without destinations, or before a node it
+		already passed through, which then ends it as a loop. There can
+		be exponentially many; limit caps how many are yielded.
+		"""
+		if key not in self.nodes: raise KeyError(key)
+
+		count = 0
+		stack = [(key, [(None, key)], 0)]
+		while len(stack):
+			node, path, i = stack.pop()
+			edges = self.edges[node]
+			if i == 0 and len(edges) == 0:
+				yield path
+				count += 1
+				if limit is not None and count >= limit: return
+				continue
+			if i >= len(edges): continue
+
+			stack.append((node, path, i + 1))
+			label, target = edges[i]
+			if target in [n for l, n in path]:
+				yield path + [(label, target)]
+				count += 1
+				if limit is not None and count >= limit: return
+			else:
+				stack.append((target, path + [(label, target)], 0))
+
+	def cycles(self):
+		"""Returns the loops of the graph as lists of nodes
+
+		Each is a strongly connected component of more than one node, or
+		a node leading to itself, found with Tarjan's algorithm in
+		linear time.
+		"""
+		if self._cycles is not None: return self._cycles
+
+		index = {}
+		low = {}
+		stack = []
+		on_stack = set()
+		cycles = []
+		for root in self.nodes:
+			if root in index: continue
+
+			work = [(root, 0)]
+			while len(work):
+				node, i = work.pop()
+				if i == 0:
+					index[node] = low[node] = len(index)
+					stack.append(node)
+					on_stack.add(node)
+
+				succ = self.successors(node)
+				if i < len(succ):
+					work.append((node, i + 1))
+					t = succ[i]
+					if t not in index: work.append((t, 0))
+					elif t in on_stack: low[node] = min(low[node], index[t])
+					continue
+
+				if low[node] == index[node]:
+					component = []
+					while True:
+						n = stack.pop()
+						on_stack.discard(n)
+						component.append(n)
+						if n == node: break
+					if len(component) > 1 or node in succ:
+						cycles.append(list(reversed(component)))
+
+				if len(work):
+					parent = work[-1][0]
+					low[parent] = min(low[parent], low[node])
+
+		self._cycles = cycles
+		return cycles
+
+	def unreachable(self, roots = None, modules = None):
+		"""Returns the nodes of modules no call from roots can reach
+
+		roots defaults to entry_points(), modules to every module with a
+		dest_regex but Extension, as extensions are dialled directly.
+		Queues and ring groups can be too, so for those this only says
+		no routed call leads there.
+		"""
+		if roots is None: roots = self.entry_points()
+		if modules is None:
+			modules = [n for n, cls in module.registry.items() if hasattr(cls, "dest_regex") and n != "Extension"]
+
+		seen = set()
+		for r in roots: seen.update(self.reachable(r))
+		return [k for k in self.nodes if k[0] in modules and k not in seen]
+
+	def label(self, key):
+		"""Returns the text of node key as the wiki shows the row"""
+		name, pk = key
+		if name == "": return pk
+		row = self._pbx[name].get(pk)
+		return "%s: %s" % (module.registry[name].item_name, row) if row is not None else "%s %s" % key
@@ -1,66 +1,165 @@
 import re
+import logging
 from ModuleField import *
-from PBXUtil import matching_regex, sanitary_format, module, dest
+from PBXUtil import sanitary_format, module, dest, ModuleGraph, sql_errors, no_such_table
+from PBXQuery import QuerySet
 from collections import OrderedDict as ODict
 
 class ModuleMeta(type):
+	def __new__(meta, name, bases, dict):
+		# rows only hold what Module.__slots__ names
+		dict.setdefault("__slots__", ())
+		return super(ModuleMeta, meta).__new__(meta, name, bases, dict)
+
 	def __init__(cls, name, bases, dict):
 		if not hasattr(module, "registry"): module.registry = ODict()
 		if not hasattr(module, "regex_registry"): module.regex_registry = {}
+		if not hasattr(module, "graph"): module.graph = ModuleGraph()
 
 		if name != "Module":
-			print("Loading module: %s" % cls.__name__)
+			logging.getLogger(__name__).debug("Loading module: %s", cls.__name__)
 			for k,v in cls.fields.items():
 				if v.xpath_location is not None:
 					cls._has_xpath = True
 					break
 
+			# the schema shared by every row of the module
+			cls._field_list = list(cls.fields.values())
+			cls._field_index = {k: i for i, k in enumerate(cls.fields)}
+
 			module.registry[cls.__name__] = cls
 			cls.name = cls.__name__
 			if hasattr(cls, 'dest_regex'):
 				module.regex_registry[cls.dest_regex] = name
+				module.resolver = None
+
+			edges = []
+			dest_user = False
+			for f in cls.fields.values():
+				if isinstance(f, ForeignKeyField): edges.append((f.module, "fk"))
+				elif isinstance(f, ManyToManyField): edges.append((f.module, "m2m"))
+				elif isinstance(f, DestinationField):
+					dest_user = True
+					edges += [(m, "dest") for m in DestinationField.special_modules]
+
+			module.graph.add(name, edges, dest_user, hasattr(cls, 'dest_regex'))
 
 		super(ModuleMeta, cls).__init__(name, bases, dict)
 
+# marks a column a partial row was read without
+_DEFERRED = object()
+
 class Module(metaclass=ModuleMeta):
+	"""A module of the PBX, or with from_row one row of it
+
+	A row keeps a list of its fields, in the order of fields, each
+	either the raw column or, once first accessed, the FieldValue the
+	field converted it to. Everything else about a field is in the field
+	itself, shared by every row.
+	"""
+
+	__slots__ = ("_pbx", "_values", "_page_param")
 
 	_has_xpath = False
+	# False for modules whose pk_field is shared by several rows, such
+	# as the entries of an IVR; their rows are never kept in the
+	# identity map, as the key would not tell them apart
+	unique_pk = True
 
 	def __init__(self, pbx):
-		self._instanced_fields = ODict()
 		self._pbx = pbx
-		self._is_instance = False
+		self._values = None
+		self._page_param = None
 
 	def is_object_instance(self):
-		return self._is_instance
+		return self._values is not None
 
 	@classmethod
-	def from_row(cls, pbx, row):
-		obj = cls(pbx)
-		obj._is_instance = True
-
+	def from_row(cls, pbx, row, partial = False):
+		"""Wraps a row of cls as an instance
+
+		Fields are converted on first access, so nothing is done here
+		beyond caching the row by its primary key: the config page of
+		the row is only fetched once a field read from it is used, and
+		the children of a ManyToManyField are only queried when that
+		field is.
+
+		With partial set, row holds only some of the columns and the
+		whole row is read once one of the others is used. Such rows are
+		not cached, and the cached row is returned if there is one.
+		"""
 		if row is None: return None
 
-		if cls._has_xpath:
-			page = pbx.get_config_from_param(**cls.config_param(row))
+		if partial and cls.unique_pk:
+			cached = pbx.cached_row(cls, row.get(cls.pk_field))
+			if cached is not None: return cached
 
+		obj = cls(pbx)
+		raw = []
 		for name, info in cls.fields.items():
-			if info.xpath_location is not None:
-				try:
-					row[name] = page.xpath(info.xpath_location)[0]
-				except:
-					row[name] = None
-
 			if not name in row and isinstance(info, ManyToManyField):
-				row[name] = row[obj.pk_field]
-			if not name in row or row[name] == None:
-				obj._instanced_fields[name] = info.populate_null()
-			else:
-				obj._instanced_fields[name] = info.populate(pbx, row[name])
+				raw.append(row.get(cls.pk_field))
+			elif partial: raw.append(row.get(name, _DEFERRED))
+			else: raw.append(row.get(name))
+
+		obj._values = raw
+		if cls._has_xpath: obj._page_param = cls.config_param(row)
+
+		if not partial and cls.unique_pk and hasattr(cls, "pk_field") and obj[cls.pk_field].value is not None:
+			pbx.cache_row(cls, obj[cls.pk_field].value, obj)
 		return obj
 
+	def _convert(self, i):
+		# a column converted twice by racing threads gives equal values,
+		# so either FieldValue can be kept
+		info = self._field_list[i]
+		if info.xpath_location is not None:
+			self._convert_page()
+			return self._values[i]
+
+		raw = self._values[i]
+		if raw is _DEFERRED:
+			self._load_deferred()
+			raw = self._values[i]
+			if isinstance(raw, FieldValue): return raw
+
+		value = info.value_class(info, self, None if raw is None else info.convert(self._pbx, raw))
+		self._values[i] = value
+		return value
+
+	def _load_deferred(self):
+		pk = self._values[self._field_index[self.pk_field]]
+		if isinstance(pk, FieldValue): pk = pk.value
+		full = self.__class__(self._pbx).get(pk)
+
+		for i, info in enumerate(self._field_list):
+			if self._values[i] is not _DEFERRED: continue
+			v = None if full is None else full._values[i]
+			if isinstance(v, FieldValue): v = info.value_class(info, self, v.value)
+			self._values[i] = v
+
+	def _convert_page(self):
+		page = self._pbx.get_config_from_param(**self._page_param)
+		for i, info in enumerate(self._field_list):
+			if info.xpath_location is None or isinstance(self._values[i], FieldValue): continue
+
+			try:
+				raw = page.xpath(info.xpath_location)[0]
+			except:
+				raw = None
+			self._values[i] = info.value_class(info, self, None if raw is None else info.convert(self._pbx, raw))
+
 	def get(self, pk):
-		cur = self._pbx.get_sql_cursor()
+		if self.unique_pk:
+			cached = self._pbx.cached_row(self.__class__, pk)
+			if cached is not None: return cached
+
+		snap = self._pbx.snapshot_table(self.__class__)
+		if snap is not None:
+			row = snap.get(self.pk_field, pk)
+			return self.from_row(self._pbx, row)
+
+		cur = self._pbx.stats.cursor(self._pbx.get_sql_cursor(), self.__class__.__name__, "get")
 		q = sanitary_format("SELECT * FROM {table} WHERE {pk}=%s;",
 			table = self.db_table, pk = self.pk_field)
 
@@ -69,36 +168,145 @@ class Module(metaclass=ModuleMeta):
 		row = cur.fetchone()
 		return self.from_row(self._pbx, row)
 
-	def all(self):
+	def get_many(self, pks):
+		result = []
+		missing = []
+		for pk in set(pks):
+			cached = self._pbx.cached_row(self.__class__, pk) if self.unique_pk else None
+			if cached is not None: result.append(cached)
+			else: missing.append(pk)
+
+		if len(missing) == 0: return result
+		pks = missing
+
+		snap = self._pbx.snapshot_table(self.__class__)
+		if snap is not None:
+			rows = [snap.get(self.pk_field, pk) for pk in pks]
+			return result + [self.from_row(self._pbx, row) for row in rows if row is not None]
+
+		cur = self._pbx.stats.cursor(self._pbx.get_sql_cursor(), self.__class__.__name__, "get_many")
+		q = sanitary_format("SELECT * FROM {table} WHERE {pk} IN (__in__);",
+			table = self.db_table, pk = self.pk_field)
+
+		q = q.replace("__in__", ", ".join(["%s"] * len(pks)))
+
+		cur.execute(q, pks)
+
+		return result + [self.from_row(self._pbx, row) for row in cur.fetchall()]
+
+	def all(self, prefetch = True):
+		"""Returns every row of this module
+
+		Args:
+			prefetch: True to prefetch the targets of every ForeignKeyField,
+				a list of field names to only prefetch those, or False to
+				leave them to be looked up one by one when dereferenced.
+		"""
 		self._pbx.update_status("Processing module: " + self.description)
-		cur = self._pbx.get_sql_cursor()
 
-		order = self.pk_field
-		if hasattr(self, 'ordering'):
-			order = self.ordering
+		snap = self._pbx.snapshot_table(self.__class__)
+		if snap is not None:
+			rows = snap.ordered(snap.rows, self._ordering())
+		else:
+			cur = self._pbx.stats.cursor(self._pbx.get_sql_cursor(), self.__class__.__name__, "all")
+			cur.execute(self._select_all())
+			rows = cur.fetchall()
+
+		return self._build(rows, prefetch)
+
+	def iter_all(self, batch_size = 500, prefetch = True):
+		"""Yields every row of this module, batch_size rows at a time
+
+		Modules ordered on a unique primary key are read from the
+		database a batch per query (see PBX.iter_sql), so the memory used
+		is proportional to the batch rather than to the table, short of
+		the rows kept in the identity map; others are read in one query.
+		The config pages and foreign keys of each batch are prefetched
+		together. prefetch is as for all.
+		"""
+		self._pbx.update_status("Processing module: " + self.description)
 
-		q = sanitary_format("SELECT * FROM {table} ORDER BY {order};",
+		snap = self._pbx.snapshot_table(self.__class__)
+		if snap is not None:
+			rows = snap.ordered(snap.rows, self._ordering())
+			batches = (rows[i:i + batch_size] for i in range(0, len(rows), batch_size))
+		else:
+			# keyset paging needs the rows ordered on a unique key
+			key = self.pk_field if self.unique_pk and self._ordering() == self.pk_field else None
+			q = self._select_all() if key is None else sanitary_format("SELECT * FROM {table};", table = self.db_table)
+			batches = self._pbx.iter_sql(q, batch_size = batch_size, key = key,
+				source = (self.__class__.__name__, "iter_all"))
+
+		for rows in batches:
+			for obj in self._build(rows, prefetch):
+				yield obj
+
+	def _select_all(self):
+		order = self._ordering()
+		return sanitary_format("SELECT * FROM {table} ORDER BY {order};",
 			table = self.db_table, order = order)
 
-		cur.execute(q)
+	def _build(self, rows, prefetch):
+		self._pbx.prefetch_pages(self.page_params(rows))
 
-		result = []
-		for row in cur.fetchall():
-			obj = self.from_row(self._pbx, row)
-			result.append(obj)
+		result = [self.from_row(self._pbx, row) for row in rows]
+
+		if prefetch:
+			self.prefetch_related(result, None if prefetch is True else prefetch)
+
+		for obj in result:
 			self._pbx.update_subtask("\tProcessed: " + str(obj))
 
 		return result
 
+	def prefetch_related(self, objs, fields = None):
+		"""Resolves foreign keys of objs with one query per target module
+
+		Every ForeignKeyField named in fields (all of them if None) has its
+		referenced values collected across objs, fetched with a single
+		IN (...) query per target module and attached to the referencing
+		rows, so dereferencing them later does not hit the database.
+		"""
+		if fields is None:
+			fields = [k for k, v in self.fields.items() if isinstance(v, ForeignKeyField)]
+
+		targets = ODict()
+		for name in fields:
+			targets.setdefault(self.fields[name].module, []).append(name)
+
+		for mod, names in targets.items():
+			target = self._pbx[mod]
+			if not hasattr(target, "db_table"): continue
+
+			refs = [o[n] for o in objs for n in names]
+			refs = [f for f in refs if f.value is not None and f.isref()]
+			if len(refs) == 0: continue
+
+			found = dict([(str(t[t.pk_field].value), t)
+				for t in target.get_many([f.value for f in refs])])
+
+			for f in refs:
+				f.attach(found.get(str(f.value)))
+
 	def __len__(self):
+		snap = self._pbx.snapshot_table(self.__class__)
+		if snap is not None: return len(snap)
+
+		# a PBX that cannot query raises, only a missing table counts 0
+		cur = self._pbx.stats.cursor(self._pbx.get_sql_cursor(), self.__class__.__name__, "__len__")
 		try:
-			cur = self._pbx.get_sql_cursor()
 			q = sanitary_format("SELECT COUNT(*) as COUNT FROM {table};", table = self.db_table)
 			cur.execute(q)
 			return cur.fetchone()["COUNT"]
-		except:
+		except sql_errors() as e:
+			if not no_such_table(e): raise
 			return 0
 
+	def _ordering(self):
+		if hasattr(self, 'ordering'):
+			return self.ordering
+		return self.pk_field
+
 	@staticmethod
 	def _construct_ordering(order_str):
 		fields = order_str.split(",")
@@ -112,54 +320,77 @@ class Module(metaclass=ModuleMeta):
 
 		return ", ".join(fields)
 
+	@staticmethod
+	def _conditions(kwargs):
+		conditions = []
+		for f, v in kwargs.items():
+			f = f.split("__")
+			if len(f) == 1: f.append("eq")
+			conditions.append((f[0], f[1], v))
+		return conditions
+
+	def query(self):
+		"""Returns a QuerySet of every row of this module"""
+		return QuerySet(self)
+
 	def filter(self, **kwargs):
-		cur = self._pbx.get_sql_cursor()
-		operands = { "eq": "=", "neq": "<>", "lt": "<", "lte": "<=", "gt": ">", "gte": ">=", "like": "LIKE" }
+		return self.query().filter(**kwargs)
 
-		order = self.pk_field
-		if hasattr(self, 'ordering'):
-			order = self.ordering
+	def _related_modules(self):
+		# every module reached through foreign keys, many-to-many fields
+		# and destinations, whose rows populating and showing this
+		# module's rows may need
+		return [module.registry[n] for n in module.graph.closure(self.name)]
 
-		clause = ""
-		for f,v in kwargs.items():
-			f = f.split("__")
-			if len(f) == 1: f.append("eq")
-			f[1] = operands[f[1]]
+	async def aprepare(self, rows_of = None):
+		"""Loads the tables and config pages this module's rows need
 
-			if clause == "":
-				clause = sanitary_format("{field} __op__ '{value}'", field = f[0],
-					value = str(v))
-			else:
-				clause = clause + sanitary_format(" AND {field} __op__ '{value}'", field = f[0],
-					value = str(v))
+		For use with an AsyncPBX. rows_of picks the snapshot rows whose
+		config pages are fetched, all of them if None.
+		"""
+		await self._pbx.load_tables([self.__class__] + self._related_modules())
 
-			clause = clause.replace("__op__", f[1])
+		if self._has_xpath:
+			snap = self._pbx.snapshot_table(self.__class__)
+			rows = snap.rows if rows_of is None else rows_of(snap)
+			await self._pbx.fetch_pages(self.page_params(rows))
 
-		q = sanitary_format("SELECT * FROM {__table__} WHERE __clause__ ORDER BY {__order__};",
-				__table__ = self.db_table, __order__ = order)
+	def page_params(self, rows):
+		'''Returns the parameters of the config pages rows are read from'''
+		if not self._has_xpath: return []
+		return [self.config_param(row) for row in rows]
 
-		q = q.replace("__clause__", clause)
+	async def aget(self, pk):
+		await self.aprepare(lambda snap: [r for r in [snap.get(self.pk_field, pk)] if r is not None])
+		return self.get(pk)
 
-		cur.execute(q)
+	async def afilter(self, **kwargs):
+		await self.aprepare(lambda snap: snap.filter(self._conditions(kwargs)))
+		return list(self.filter(**kwargs))
 
-		return [self.from_row(self._pbx, row) for row in cur.fetchall()]
+	async def aall(self, prefetch = True):
+		await self.aprepare()
+		return self.all(prefetch)
 
 	def __getitem__(self, field):
 		if self.is_object_instance():
-			return self._instanced_fields[field]
+			i = self._field_index[field]
+			value = self._values[i]
+			if isinstance(value, FieldValue): return value
+			return self._convert(i)
 		else: return self.get(field)
 
 	def __repr__(self):
-		if len(self._instanced_fields) == 0:
+		if not self.is_object_instance():
 			return "Module: " + self.description
 
 		desc_fields = re.findall(r"{([\w-]*)}", self.repr_format)
-		format_dict = dict([(f, str(self[f])) for f in desc_fields if f in self._instanced_fields])
+		format_dict = dict([(f, str(self[f])) for f in desc_fields if f in self.fields])
 		return self.repr_format.format( **format_dict )
 
 	def __iter__(self):
-		for k,v in self._instanced_fields.items():
-			yield k,v
+		for k in self.fields:
+			yield k, self[k]
 
 	def config_url(self):
 		if not hasattr(self, "config_param"): return None
@@ -283,6 +514,7 @@ class DirectoryEntry(Module):
 	repr_format = "{name}"
 	db_table = "directory_entries"
 	pk_field = "id"
+	unique_pk = False
 
 	render_template = None
 
@@ -395,7 +627,16 @@ class Blacklist(Module):
 	def __len__(self):
 		return len(self.all())
 
-	def all(self):
+	async def aprepare(self, rows_of = None):
+		await self._pbx.fetch_pages(self.page_params([]))
+
+	def page_params(self, rows):
+		return [{"display": "blacklist"}]
+
+	def iter_all(self, batch_size = None, prefetch = True):
+		return iter(self.all())
+
+	def all(self, prefetch = True):
 		page = self._pbx.get_config_from_param(display="blacklist")
 		try:
 			child = page.xpath('(//h5[text()="Blacklist entries"])/../../..')[0].getchildren()[2:]
@@ -451,6 +692,7 @@ class IVREntry(Module):
 	render_template = None
 	db_table = "ivr_entries"
 	pk_field = "ivr_id"
+	unique_pk = False
 
 	fields = ODict([
 			("ivr_id", IntField()),
@@ -0,0 +1,244 @@
+import time
+import atexit
+import logging
+import threading
+
+from PBXUtil import LazyModule
+
+MySQLdb = LazyModule("MySQLdb")
+
+class PBXPoolError(Exception):
+	pass
+
+class SQLPool:
+	"""Pool of MySQL connections to one PBX over a shared SSH tunnel
+
+	Pools are kept per (host, ssh username, password), so PBX instances
+	for the same host and credentials reuse the tunnel and any idle
+	connections, and other credentials get a pool of their own. Every
+	for_host is matched by a detach. A pool nobody is attached to keeps
+	its tunnel open for idle_timeout seconds so that the next run against
+	the host does not reopen it; close_idle closes the ones past that,
+	and close_all, registered with atexit, closes every pool. The root
+	password variant
+	that logged in first (the given password, or an empty one) is
+	remembered and tried alone afterwards. Idle connections are pinged
+	before being handed out again, and the tunnel is restarted if it has
+	gone down.
+	"""
+
+	_pools = {}
+	_pools_lock = threading.Lock()
+	# seconds a pool nobody is attached to stays open
+	idle_timeout = 300
+
+	@classmethod
+	def for_host(cls, host, username, password, size = 8, timeout = None):
+		cls.close_idle()
+		key = (host, username, password)
+		with cls._pools_lock:
+			pool = cls._pools.get(key)
+			if pool is None:
+				pool = cls(host, username, password, size, timeout)
+				cls._pools[key] = pool
+			elif pool.size < size:
+				pool.size = size
+			pool.users += 1
+			pool.idle_since = None
+			return pool
+
+	def detach(self):
+		"""Gives up a for_host; the pool stays open until close_idle or close_all"""
+		with self._pools_lock:
+			self.users -= 1
+			if self.users == 0: self.idle_since = time.time()
+
+	@classmethod
+	def close_idle(cls, max_idle = None):
+		"""Closes the pools nobody has been attached to for max_idle seconds
+
+		max_idle defaults to idle_timeout; 0 closes every unused pool.
+		"""
+		if max_idle is None: max_idle = cls.idle_timeout
+		now = time.time()
+		with cls._pools_lock:
+			idle = [key for key, pool in cls._pools.items()
+					if pool.users == 0 and now - pool.idle_since >= max_idle]
+			pools = [cls._pools.pop(key) for key in idle]
+		for pool in pools:
+			pool.close()
+
+	@classmethod
+	def close_all(cls):
+		with cls._pools_lock:
+			pools = list(cls._pools.values())
+			cls._pools = {}
+		for pool in pools:
+			pool.close()
+
+	def __init__(self, host, username, password, size = 8, timeout = None):
+		self.host = host
+		self.size = size
+		# seconds the SSH handshake and MySQL login may take
+		self.timeout = timeout
+		self._username = username
+		self._password = password
+		self._working_password = None
+		self.users = 0
+		self.idle_since = None
+
+		self._tunnel = None
+		self._idle = []
+		self._open = 0
+		self._cond = threading.Condition()
+
+		self.created = 0
+		self.acquired = 0
+		self.waits = 0
+		self.wait_time = 0.0
+		self.max_wait = 0.0
+		self.broken = 0
+		self.tunnel_restarts = 0
+
+	def _ensure_tunnel(self):
+		with self._cond:
+			if self._tunnel is not None and self._tunnel.is_active:
+				return self._tunnel
+
+			if self._tunnel is not None:
+				self.tunnel_restarts += 1
+				self._tunnel.stop()
+
+			# paramiko is slow to import, so only when a tunnel is opened
+			import sshtunnel
+
+			ssh_logger = logging.getLogger("ssh-logger")
+			ssh_logger.disabled = True
+
+			# sshtunnel only takes the timeout of its sockets globally
+			if self.timeout is not None: sshtunnel.SSH_TIMEOUT = self.timeout
+
+			self._tunnel = sshtunnel.SSHTunnelForwarder(
+						(self.host, 22),
+						ssh_username=self._username,
+						ssh_password=self._password,
+						remote_bind_address=('localhost', 3306),
+						logger = ssh_logger)
+			try:
+				self._tunnel.start()
+			except sshtunnel.BaseSSHTunnelForwarderError as e:
+				self._tunnel = None
+				raise PBXPoolError("Cannot open SSH tunnel: %s" % e)
+			return self._tunnel
+
+	def local_port(self):
+		return self._ensure_tunnel().local_bind_port
+
+	def password_variants(self):
+		if self._working_password is not None:
+			return [self._working_password]
+		return [self._password, '']
+
+	def remember_password(self, password):
+		self._working_password = password
+
+	def _connect(self):
+		port = self.local_port()
+		# MySQL takes whole seconds
+		kwargs = {} if self.timeout is None else {"connect_timeout": max(1, int(self.timeout))}
+		for password in self.password_variants():
+			try:
+				handle = MySQLdb.connect('127.0.0.1', 'root', password, 'asterisk', port, **kwargs)
+			except MySQLdb.Error:
+				continue
+
+			self.remember_password(password)
+			self.created += 1
+			return handle
+
+		raise PBXPoolError("Cannot log in to SQL")
+
+	def acquire(self, timeout = 60):
+		start = time.time()
+		handle = None
+		with self._cond:
+			waited = False
+			while len(self._idle) == 0 and self._open >= self.size:
+				waited = True
+				remaining = timeout - (time.time() - start)
+				if remaining <= 0 or not self._cond.wait(remaining):
+					raise PBXPoolError("Timed out waiting for an SQL connection")
+
+			if len(self._idle): handle = self._idle.pop()
+			else: self._open += 1
+
+			self.acquired += 1
+			if waited:
+				elapsed = time.time() - start
+				self.waits += 1
+				self.wait_time += elapsed
+				self.max_wait = max(self.max_wait, elapsed)
+
+		if handle is not None:
+			try:
+				handle.ping()
+				return handle
+			except MySQLdb.Error:
+				self.broken += 1
+				self._close_handle(handle)
+
+		try:
+			return self._connect()
+		except:
+			with self._cond:
+				self._open -= 1
+				self._cond.notify()
+			raise
+
+	def release(self, handle):
+		with self._cond:
+			self._idle.append(handle)
+			self._cond.notify()
+
+	def discard(self, handle):
+		self._close_handle(handle)
+		with self._cond:
+			self._open -= 1
+			self._cond.notify()
+
+	@staticmethod
+	def _close_handle(handle):
+		try:
+			handle.close()
+		except MySQLdb.Error:
+			pass
+
+	def close(self):
+		with self._cond:
+			for handle in self._idle:
+				self._close_handle(handle)
+			self._open -= len(self._idle)
+			self._idle = []
+			if self._tunnel is not None:
+				self._tunnel.stop()
+				self._tunnel = None
+
+	def stats(self):
+		with self._cond:
+			return {
+				"host": self.host,
+				"size": self.size,
+				"open": self._open,
+				"idle": len(self._idle),
+				"in_use": self._open - len(self._idle),
+				"created": self.created,
+				"acquired": self.acquired,
+				"waits": self.waits,
+				"wait_time": self.wait_time,
+				"max_wait": self.max_wait,
+				"broken": self.broken,
+				"tunnel_active": self._tunnel is not None and self._tunnel.is_active,
+				"tunnel_restarts": self.tunnel_restarts,
+			}
+
+atexit.register(SQLPool.close_all)
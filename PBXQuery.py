@@ -0,0 +1,185 @@
+from PBXUtil import sanitary_format
+
+class QuerySet:
+	"""Lazily evaluated query on the rows of one module
+
+	Made by Module.query and Module.filter and refined by chaining
+	filter, order_by, only, values and slices, each returning a new
+	QuerySet. Nothing is run until the rows are iterated, counted or
+	indexed; the result is then kept, so a QuerySet runs at most once.
+
+	Lookups are written field__op=value with op one of eq (the
+	default), neq, lt, lte, gt, gte, like and in, the last taking a
+	list. Values are bound as query parameters, so the statement text
+	only depends on the shape of the query. In snapshot mode the rows
+	come from the in-memory table instead.
+
+		pbx["Extension"].filter(extension__in = [100, 101]).order_by("name-")[:10]
+	"""
+
+	operands = { "eq": "=", "neq": "<>", "lt": "<", "lte": "<=", "gt": ">", "gte": ">=", "like": "LIKE", "in": "IN" }
+
+	def __init__(self, mod):
+		self._module = mod
+		self._conditions = []
+		self._order = None
+		self._fields = None
+		self._values = False
+		self._offset = 0
+		self._limit = None
+		self._result = None
+
+	def _clone(self):
+		qs = QuerySet(self._module)
+		qs._conditions = list(self._conditions)
+		qs._order = self._order
+		qs._fields = self._fields
+		qs._values = self._values
+		qs._offset = self._offset
+		qs._limit = self._limit
+		return qs
+
+	def filter(self, **kwargs):
+		"""Narrows the rows down to those matching every lookup"""
+		qs = self._clone()
+		for f, op, v in self._module._conditions(kwargs):
+			if op not in self.operands: raise ValueError("Unknown lookup: %s__%s" % (f, op))
+			if op == "in": v = list(v)
+			qs._conditions.append((f, op, v))
+		return qs
+
+	def order_by(self, *fields):
+		"""Orders by fields, each suffixed with - for descending order
+
+		Without fields the module's own ordering is used.
+		"""
+		qs = self._clone()
+		qs._order = ",".join(fields) if len(fields) else None
+		return qs
+
+	def only(self, *fields):
+		"""Selects only fields (and the primary key) from the database
+
+		The other fields of the rows read the whole row from the
+		database, once, when first used. Rows read this way are not kept
+		in the identity map. Modules without a unique_pk read whole rows,
+		as the primary key could not find the row again.
+		"""
+		qs = self._clone()
+		if self._module.unique_pk: qs._fields = self._with_pk(fields)
+		return qs
+
+	def values(self, *fields):
+		"""Returns the raw columns of fields (every field if none) as dicts"""
+		qs = self._clone()
+		qs._fields = list(fields) if len(fields) else None
+		qs._values = True
+		return qs
+
+	def first(self):
+		rows = self[:1]
+		return rows[0] if len(rows) else None
+
+	def _with_pk(self, fields):
+		pk = self._module.pk_field
+		return [pk] + [f for f in fields if f != pk]
+
+	def _ordering(self):
+		if self._order is not None: return self._order
+		return self._module._ordering()
+
+	def _cache_key(self):
+		key = dict([("%s__%s" % (f, op), tuple(v) if op == "in" else v) for f, op, v in self._conditions])
+		if self._order is not None: key["__order__"] = self._order
+		if self._offset or self._limit is not None: key["__slice__"] = (self._offset, self._limit)
+		return key
+
+	def _run(self):
+		if self._result is not None: return self._result
+
+		mod = self._module
+		pbx = mod._pbx
+		cacheable = not self._values and self._fields is None
+
+		if cacheable:
+			cached = pbx.cached_query(mod.__class__, self._cache_key())
+			if cached is not None:
+				self._result = cached
+				return cached
+
+		snap = pbx.snapshot_table(mod.__class__)
+		if snap is not None:
+			rows = snap.ordered(snap.filter(self._conditions), self._ordering())
+			end = None if self._limit is None else self._offset + self._limit
+			rows = rows[self._offset:end]
+			partial = False
+		else:
+			rows = self._select()
+			partial = self._fields is not None
+
+		if self._values:
+			fields = self._fields or list(mod.fields.keys())
+			result = [dict([(f, row.get(f)) for f in fields]) for row in rows]
+		else:
+			result = [mod.from_row(pbx, row, partial) for row in rows]
+
+		if cacheable: pbx.cache_query(mod.__class__, self._cache_key(), result)
+		self._result = result
+		return result
+
+	def _select(self):
+		mod = self._module
+		where = []
+		params = []
+		for f, op, v in self._conditions:
+			if op == "in":
+				if len(v) == 0: return []
+				where.append(sanitary_format("{field} IN ", field = f) + "(%s)" % ", ".join(["%s"] * len(v)))
+				params += v
+			else:
+				where.append(sanitary_format("{field} ", field = f) + self.operands[op] + " %s")
+				params.append(v)
+
+		columns = "*"
+		if self._fields is not None:
+			columns = ", ".join([sanitary_format("{field}", field = f) for f in self._fields])
+
+		q = "SELECT %s FROM %s" % (columns, sanitary_format("{table}", table = mod.db_table))
+		if len(where): q += " WHERE " + " AND ".join(where)
+		q += " ORDER BY " + mod._construct_ordering(self._ordering())
+		if self._limit is not None: q += " LIMIT %d OFFSET %d" % (self._limit, self._offset)
+		elif self._offset: q += " LIMIT 18446744073709551615 OFFSET %d" % self._offset
+
+		cur = mod._pbx.stats.cursor(mod._pbx.get_sql_cursor(), mod.__class__.__name__, "filter")
+		cur.execute(q + ";", params)
+		return cur.fetchall()
+
+	def __getitem__(self, k):
+		if isinstance(k, slice):
+			if self._result is not None: return self._result[k]
+			if k.step is not None or (k.start or 0) < 0 or (k.stop is not None and k.stop < 0):
+				return list(self)[k]
+
+			qs = self._clone()
+			start = k.start or 0
+			qs._offset = self._offset + start
+			if k.stop is not None:
+				stop = max(k.stop, start)
+				qs._limit = stop - start if self._limit is None else min(stop - start, max(self._limit - start, 0))
+			elif self._limit is not None:
+				qs._limit = max(self._limit - start, 0)
+			return qs
+
+		return self._run()[k]
+
+	def __iter__(self):
+		return iter(self._run())
+
+	def __len__(self):
+		return len(self._run())
+
+	def __bool__(self):
+		return len(self._run()) > 0
+
+	def __repr__(self):
+		return repr(self._run())
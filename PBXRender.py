@@ -0,0 +1,236 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from PBXUtil import module
+
+def capfirst(s):
+	return s[0].upper() + s[1:]
+
+def debug(s):
+	print(s)
+
+def template_names():
+	"""wiki.tpl and the render_template of every registered module"""
+	names = ["wiki.tpl"]
+	for cls in module.registry.values():
+		if cls.render_template is not None and cls.render_template not in names:
+			names.append(cls.render_template)
+	return names
+
+def make_environment(path = "./templates", bytecode_cache = True, bytecode_cache_dir = None):
+	"""Returns a new Environment for the templates in path
+
+	Compiled templates are kept in a FileSystemBytecodeCache in
+	bytecode_cache_dir, or a private directory in the system temporary
+	directory if None, so later runs do not parse them again; a changed
+	template is compiled again. The templates of template_names are
+	loaded up front and not checked for changes afterwards, so rendering
+	only looks them up. Use environment() to share one Environment.
+	"""
+	cache = FileSystemBytecodeCache(bytecode_cache_dir) if bytecode_cache else None
+	j2_env = Environment(loader=FileSystemLoader(path), trim_blocks=True,
+		auto_reload=False, bytecode_cache=cache)
+	j2_env.filters["capfirst"] = capfirst
+	j2_env.filters["debug"] = debug
+
+	for name in template_names():
+		j2_env.get_template(name)
+	return j2_env
+
+_environments = {}
+_environments_lock = threading.Lock()
+
+def environment(path = "./templates"):
+	"""Returns the Environment for the templates in path shared by the process
+
+	It is made by make_environment on first use. Rendering with it is
+	thread safe, so every PBX and worker can use the same one.
+	"""
+	key = os.path.abspath(path)
+	with _environments_lock:
+		if key not in _environments:
+			_environments[key] = make_environment(path)
+		return _environments[key]
+
+def render_module(j2_env, m):
+	"""Yields the wiki text of module m as the template produces it
+
+	The time from the first chunk being asked for to the last, which
+	includes whatever the caller does in between, is recorded in the
+	render stats of the PBX.
+	"""
+	start = time.perf_counter()
+	for chunk in j2_env.get_template("wiki.tpl").generate(m=m, nl="\n"):
+		yield chunk.replace("\t", "")
+	m._pbx.stats.render(m.__class__.__name__, start, time.perf_counter() - start)
+
+def write_wiki(j2_env, modules, f, workers = 1):
+	"""Writes the wiki text of every module to the file f
+
+	With a single worker nothing is accumulated: each chunk is written
+	as soon as it is rendered. With more, modules are rendered by
+	spool_modules and their text is copied in the order of modules as
+	each one completes, so it is never held in memory either. The file
+	is flushed, and the PBX's update_percent called, after every module.
+	"""
+	def written(i):
+		f.flush()
+		modules[i]._pbx.update_percent(100 * (i + 1) // len(modules))
+
+	if workers <= 1:
+		for i, m in enumerate(modules):
+			for chunk in render_module(j2_env, m):
+				f.write(chunk)
+			written(i)
+		return
+
+	for i, spool in enumerate(spool_modules(j2_env, modules, workers)):
+		with spool:
+			shutil.copyfileobj(spool, f)
+		written(i)
+
+def spool_modules(j2_env, modules, workers = 1):
+	"""Yields a temporary file holding the wiki text of every module
+
+	Like render_modules, but each module is written to a file of its
+	own as it is rendered, which is yielded in the order of modules,
+	rewound. Closing a file deletes it.
+	"""
+	def render(m):
+		spool = tempfile.TemporaryFile("w+")
+		try:
+			for chunk in render_module(j2_env, m):
+				spool.write(chunk)
+			spool.seek(0)
+			return spool
+		except:
+			spool.close()
+			raise
+		finally:
+			m._pbx.release_sql()
+
+	with ThreadPoolExecutor(workers) as pool:
+		for spool in pool.map(render, modules):
+			yield spool
+
+def render_modules(j2_env, modules, workers = 1):
+	"""Yields the whole wiki text of every module, in the order of modules
+
+	Up to workers modules are rendered at once on a thread pool, each
+	thread querying the PBX over an SQL connection taken from the pool.
+	"""
+	def render(m):
+		# hand the thread's SQL connection back between modules so the
+		# pool is shared with whatever else is querying this PBX
+		try:
+			return "".join(render_module(j2_env, m))
+		finally:
+			m._pbx.release_sql()
+
+	if workers <= 1:
+		for m in modules: yield render(m)
+		return
+
+	with ThreadPoolExecutor(workers) as pool:
+		for text in pool.map(render, modules):
+			yield text
+
+def document(pbx, j2_env, path, workers = 1):
+	"""Writes the wiki of every module with rows on pbx to path"""
+	to_render = []
+	for m in pbx:
+		if m.render_template is not None and len(m) > 0: to_render.append(m)
+
+	pbx.prewarm([m.__class__ for m in to_render])
+
+	pbx.update_status("Writing output")
+	with open(path, "w") as f:
+		write_wiki(j2_env, to_render, f, workers)
+
+class WikiDocument:
+	"""Wiki of one PBX that is kept up to date by re-rendering changed modules
+
+	The PBX must be in snapshot mode. The text of every module is kept
+	in memory; refresh() checksums the module tables, reloads the ones
+	that changed and re-renders them along with the modules whose text
+	shows their rows (see PBX.dependent_modules), then rewrites the file.
+	Modules without a table of their own are read from config pages
+	only, so those pages are fetched and the modules re-rendered on
+	every refresh. The pages of modules with a table that read fields
+	from pages too are fetched on every refresh as well, and those
+	modules re-rendered like changed tables when the pages changed.
+	"""
+
+	def __init__(self, pbx, j2_env, path, workers = 1):
+		self.pbx = pbx
+		self.j2_env = j2_env
+		self.path = path
+		self.workers = workers
+
+		self._texts = {}
+		self._checksums = {}
+		self._page_checksums = {}
+
+	def update(self, classes = None):
+		"""Re-renders the modules of classes (every module if None) and writes the file"""
+		names = None if classes is None else set([cls.__name__ for cls in classes])
+
+		to_render = []
+		for m in self.pbx:
+			if names is not None and m.name not in names: continue
+			if m.render_template is not None and len(m) > 0: to_render.append(m)
+			else: self._texts.pop(m.name, None)
+
+		self.pbx.prewarm([m.__class__ for m in to_render])
+		self.pbx.update_status("Rendering %d modules" % len(to_render))
+		for m, text in zip(to_render, render_modules(self.j2_env, to_render, self.workers)):
+			self._texts[m.name] = text
+
+		self.write()
+		return [m.__class__ for m in to_render]
+
+	def write(self):
+		tmp = self.path + ".tmp"
+		with open(tmp, "w") as f:
+			for name in self.pbx.get_module_names():
+				if name in self._texts: f.write(self._texts[name])
+		os.replace(tmp, self.path)
+
+	def refresh(self):
+		"""Brings the wiki up to date, returns the classes of the re-rendered modules"""
+		pbx = self.pbx
+		checksums = pbx.table_checksums()
+		changed = [cls for cls, checksum in checksums.items()
+			if cls not in self._checksums or self._checksums[cls] != checksum]
+
+		# a change made after the checksums were taken is reloaded now
+		# and reloaded again on the next refresh, which is harmless
+		if len(changed): pbx.reload_tables(changed)
+
+		paged = [cls for cls in pbx.snapshot_modules() if cls._has_xpath]
+		page_checksums = pbx.page_checksums(paged)
+		changed_pages = [cls for cls in paged
+			if cls not in changed and self._page_checksums.get(cls) != page_checksums[cls]]
+		# rows of other modules may hold the rows read from the old pages
+		if len(changed_pages): pbx.invalidate()
+		changed += changed_pages
+
+		volatile = [cls for cls in module.registry.values() if not hasattr(cls, "db_table")]
+		for cls in volatile:
+			pbx.drop_pages(pbx[cls.__name__].page_params([]))
+			pbx.invalidate(cls)
+
+		if len(self._texts) == 0:
+			updated = self.update()
+		else:
+			affected = changed + [cls for cls in pbx.dependent_modules(changed) if cls not in changed]
+			updated = self.update(affected + [cls for cls in volatile if cls not in affected])
+
+		# only kept once written, so a refresh that failed is redone
+		self._checksums = checksums
+		self._page_checksums = page_checksums
+		return updated
@@ -0,0 +1,212 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from PBX import PBX, PBXError
+from PBXUtil import module, sanitary_format, sql_errors, no_such_table, SQLError, NO_SUCH_TABLE
+
+SNAPSHOT_FORMAT = "pbx-tools snapshot"
+SNAPSHOT_VERSION = 1
+
+def _quote(name):
+	return '"%s"' % sanitary_format("{name}", name = name)
+
+def _column(value):
+	# sqlite stores None, int, float, str and bytes as they are;
+	# anything else MySQLdb returns (Decimal, datetime) is kept as text
+	if value is None or isinstance(value, (int, float, str, bytes)): return value
+	return str(value)
+
+def export_snapshot(pbx, path):
+	"""Writes the configuration of pbx to an SQLite snapshot file at path
+
+	The file holds every registered module's table as an SQLite table of
+	the same name and columns, the normalized HTML of every config page
+	the modules read, zlib compressed, and a meta table naming the
+	format version and host. Rows come from the snapshot of pbx if it
+	has one, else from SQL, and pages are fetched through pbx, so its
+	disk page cache is used.
+	"""
+	if os.path.exists(path): os.remove(path)
+	db = sqlite3.connect(path)
+	db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+	db.execute("CREATE TABLE pages (url TEXT PRIMARY KEY, content BLOB)")
+	db.executemany("INSERT INTO meta VALUES (?, ?)", [
+			("format", SNAPSHOT_FORMAT),
+			("version", str(SNAPSHOT_VERSION)),
+			("host", pbx._base_url),
+			("created", str(time.time())),
+		])
+
+	params = []
+	for cls in pbx.snapshot_modules():
+		pbx.update_subtask("\tExporting table: " + cls.db_table)
+		snap = pbx.snapshot_table(cls)
+		if snap is not None: rows = snap.rows
+		else:
+			cur = pbx.stats.cursor(pbx.get_sql_cursor(), "PBX", "export")
+			try:
+				cur.execute(sanitary_format("SELECT * FROM {table};", table = cls.db_table))
+				rows = cur.fetchall()
+			except sql_errors() as e:
+				if not no_such_table(e): raise
+				continue
+
+		params += pbx[cls.__name__].page_params(rows)
+		if len(rows) == 0: continue
+
+		columns = list(rows[0].keys())
+		db.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (_quote(cls.db_table),
+			", ".join([_quote(c) for c in columns])))
+		db.executemany("INSERT INTO %s VALUES (%s)" % (_quote(cls.db_table), ", ".join(["?"] * len(columns))),
+			[[_column(row.get(c)) for c in columns] for row in rows])
+
+	for cls in module.registry.values():
+		if not hasattr(cls, "db_table"): params += pbx[cls.__name__].page_params([])
+
+	urls = []
+	for p in params:
+		url = pbx.config_path(p)
+		if url not in urls: urls.append(url)
+
+	def fetch(url):
+		try:
+			return url, pbx._fetch_page(url)
+		except PBXError:
+			return url, None
+
+	pbx.update_status("Exporting %d config pages" % len(urls))
+	with ThreadPoolExecutor(pbx._max_workers) as pool:
+		for url, content in pool.map(fetch, urls):
+			if content is not None:
+				db.execute("INSERT INTO pages VALUES (?, ?)", (url, zlib.compress(content)))
+
+	db.commit()
+	db.close()
+
+class SnapshotError(SQLError):
+	pass
+
+class SnapshotCursor:
+	"""DictCursor look-alike over an SQLite snapshot
+
+	Takes the MySQLdb %s parameter style, ignores the transaction
+	statements PBX issues and raises SnapshotError, which sql_errors()
+	catches along with MySQLdb's, so PBX and the modules can use it as
+	they use a MySQL cursor without MySQLdb being installed.
+	"""
+
+	def __init__(self, db):
+		self._cur = db.cursor()
+
+	def execute(self, q, params = None):
+		if q.startswith("START TRANSACTION") or q.startswith("COMMIT"): return
+		try:
+			self._cur.execute(q.replace("%s", "?"), list(params or []))
+		except sqlite3.Error as e:
+			# with the error number MySQL gives a missing table
+			if str(e).startswith("no such table"): raise SnapshotError(NO_SUCH_TABLE, str(e))
+			raise SnapshotError(str(e))
+
+	def _dict(self, row):
+		if row is None: return None
+		return dict(zip([d[0] for d in self._cur.description], row))
+
+	def fetchone(self):
+		return self._dict(self._cur.fetchone())
+
+	def fetchall(self):
+		return [self._dict(row) for row in self._cur.fetchall()]
+
+	def fetchmany(self, size = 1):
+		return [self._dict(row) for row in self._cur.fetchmany(size)]
+
+	def close(self):
+		self._cur.close()
+
+class SnapshotPBX(PBX):
+	"""PBX served entirely from a snapshot file written by export_snapshot
+
+	No network access is made: the tables are read from the file into
+	the in-memory snapshot on construction, get_sql_cursor returns a
+	SnapshotCursor on the file and config pages are read from it. Each
+	thread reads the file over its own read-only, memory mapped SQLite
+	connection.
+
+		pbx = SnapshotPBX("office.pbxsnap")
+		document(pbx, environment(), "wiki.txt")
+	"""
+
+	def __init__(self, path, **kwargs):
+		self._path = path
+		self._db_local = threading.local()
+		self._db_handles = []
+		self._db_lock = threading.Lock()
+
+		try:
+			meta = dict(self._db().execute("SELECT key, value FROM meta").fetchall())
+		except sqlite3.Error:
+			meta = {}
+		if meta.get("format") != SNAPSHOT_FORMAT:
+			raise PBXError("Not a snapshot file: " + path)
+		if int(meta.get("version", 0)) > SNAPSHOT_VERSION:
+			raise PBXError("Snapshot format version %s is newer than supported" % meta["version"])
+		self.snapshot_meta = meta
+
+		kwargs["snapshot"] = True
+		PBX.__init__(self, meta["host"], **kwargs)
+		self._web_authenticated = True
+		self._sql_connected = True
+		self.load_snapshot()
+
+	def _db(self):
+		db = getattr(self._db_local, "db", None)
+		if db is None:
+			try:
+				db = sqlite3.connect("file:%s?mode=ro" % self._path, uri = True, check_same_thread = False)
+				db.execute("PRAGMA mmap_size = 268435456")
+			except sqlite3.Error as e:
+				raise PBXError("Cannot open snapshot %s: %s" % (self._path, e))
+
+			self._db_local.db = db
+			with self._db_lock:
+				self._db_handles.append(db)
+		return db
+
+	def connect_web_config( self, username, password ):
+		pass
+
+	def connect_sql( self, username, password ):
+		pass
+
+	def get_sql_cursor( self ):
+		return SnapshotCursor(self._db())
+
+	def iter_sql( self, q, params = None, batch_size = 500, source = ("PBX", "iter_sql"), key = None ):
+		# the snapshot is local, so every query is read in one go
+		cur = self.stats.cursor(self.get_sql_cursor(), *source)
+		if key is not None: q = q.rstrip().rstrip(";") + sanitary_format(" ORDER BY {key};", key = key)
+		cur.execute(q, params)
+		while True:
+			rows = cur.fetchmany(batch_size)
+			if len(rows) == 0: break
+			yield rows
+
+	def _fetch_page( self, url ):
+		row = self._db().execute("SELECT content FROM pages WHERE url = ?", (url,)).fetchone()
+		if row is None:
+			raise PBXError("Config page not in snapshot: " + url)
+		return zlib.decompress(row[0])
+
+	def close( self ):
+		PBX.close(self)
+		with self._db_lock:
+			handles = self._db_handles
+			self._db_handles = []
+			self._db_local = threading.local()
+
+		for db in handles:
+			db.close()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import threading
+
+from collections import deque
+from urllib.parse import parse_qs
+
+class Histogram:
+	"""Count, total, maximum and bucketed distribution of latencies in seconds"""
+	__slots__ = ("count", "total", "max", "buckets")
+
+	# upper bounds of the buckets; the last bucket is everything above
+	bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = [0] * (len(self.bounds) + 1)
+
+	def add(self, elapsed):
+		self.count += 1
+		self.total += elapsed
+		if elapsed > self.max: self.max = elapsed
+
+		i = 0
+		while i < len(self.bounds) and elapsed > self.bounds[i]: i += 1
+		self.buckets[i] += 1
+
+	def to_dict(self):
+		labels = ["<=%gms" % (b * 1000) for b in self.bounds] + [">%gms" % (self.bounds[-1] * 1000)]
+		return {
+			"count": self.count,
+			"total": self.total,
+			"mean": self.total / self.count if self.count else 0.0,
+			"max": self.max,
+			"buckets": dict([(l, n) for l, n in zip(labels, self.buckets) if n]),
+		}
+
+class TimedCursor:
+	"""Cursor wrapper recording the latency of every execute in PBXStats"""
+
+	def __init__(self, stats, cur, mod, method):
+		self._stats = stats
+		self._cur = cur
+		self._module = mod
+		self._method = method
+
+	def execute(self, q, params = None):
+		start = time.perf_counter()
+		try:
+			return self._cur.execute(q, params)
+		finally:
+			self._stats.sql(self._module, self._method, start, time.perf_counter() - start, q)
+
+	def __getattr__(self, name):
+		return getattr(self._cur, name)
+
+	def __iter__(self):
+		return iter(self._cur)
+
+class PBXStats:
+	"""Counters and latency histograms of the work a PBX does
+
+	SQL statements are recorded by module and method (get, get_many,
+	all, iter_all, filter, __len__, and load_snapshot or checksum for
+	the PBX itself), config pages by their display parameter, as page
+	cache hits and as misses with the time taken to fetch them, and
+	rendering by module. Recording is thread safe.
+
+	With trace True every SQL statement, page fetch and render is also
+	kept as an event for write_chrome_trace, which chrome://tracing and
+	Perfetto open. Only the last max_events are kept, so a long running
+	process traces its recent work in bounded memory.
+	"""
+
+	def __init__(self, trace = False, max_events = 100000):
+		self.trace = trace
+		self.max_events = max_events
+		self._lock = threading.Lock()
+		self._epoch = time.perf_counter()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self._sql = {}
+			self._pages = {}
+			self._render = {}
+			self._events = deque(maxlen = self.max_events)
+
+	def cursor(self, cur, mod, method):
+		"""Wraps cur so its statements are recorded under mod and method"""
+		return TimedCursor(self, cur, mod, method)
+
+	def _event(self, cat, name, tid, start, elapsed, args):
+		self._events.append({
+			"name": name,
+			"cat": cat,
+			"ph": "X",
+			"ts": (start - self._epoch) * 1e6,
+			"dur": elapsed * 1e6,
+			"pid": os.getpid(),
+			"tid": tid,
+			"args": args,
+		})
+
+	def sql(self, mod, method, start, elapsed, q = None):
+		tid = threading.get_ident()
+		with self._lock:
+			methods = self._sql.setdefault(mod, {})
+			if method not in methods: methods[method] = Histogram()
+			methods[method].add(elapsed)
+			if self.trace: self._event("sql", "%s.%s" % (mod, method), tid, start, elapsed, {"query": q})
+
+	@staticmethod
+	def page_key(url):
+		query = url.split("?", 1)[1] if "?" in url else ""
+		return parse_qs(query).get("display", ["-"])[0]
+
+	def page_hit(self, url):
+		with self._lock:
+			self._page(url)["hits"] += 1
+
+	def page_miss(self, url, start, elapsed):
+		tid = threading.get_ident()
+		with self._lock:
+			page = self._page(url)
+			page["misses"] += 1
+			page["fetch"].add(elapsed)
+			if self.trace: self._event("page", "page:" + self.page_key(url), tid, start, elapsed, {"url": url})
+
+	def _page(self, url):
+		key = self.page_key(url)
+		if key not in self._pages:
+			self._pages[key] = {"hits": 0, "misses": 0, "fetch": Histogram()}
+		return self._pages[key]
+
+	def render(self, mod, start, elapsed):
+		tid = threading.get_ident()
+		with self._lock:
+			if mod not in self._render: self._render[mod] = Histogram()
+			self._render[mod].add(elapsed)
+			if self.trace: self._event("render", "render:" + mod, tid, start, elapsed, {})
+
+	def to_dict(self):
+		with self._lock:
+			return {
+				"sql": dict([(m, dict([(k, h.to_dict()) for k, h in methods.items()]))
+					for m, methods in self._sql.items()]),
+				"pages": dict([(k, {"hits": p["hits"], "misses": p["misses"], "fetch": p["fetch"].to_dict()})
+					for k, p in self._pages.items()]),
+				"render": dict([(m, h.to_dict()) for m, h in self._render.items()]),
+			}
+
+	def write_json(self, path, extra = None):
+		"""Writes to_dict, updated with the dict extra, to path as JSON"""
+		data = self.to_dict()
+		if extra is not None: data.update(extra)
+		with open(path, "w") as f:
+			json.dump(data, f, indent = 1, default = str)
+
+	def write_chrome_trace(self, path):
+		"""Writes the recorded events to path in the Chrome trace event format"""
+		with self._lock:
+			events = list(self._events)
+		with open(path, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default = str)
@@ -1,9 +1,81 @@
 import re
+import sys
+import importlib
 from collections import OrderedDict as ODict
 
+class LazyModule:
+	"""Stands in for the module name, importing it on first attribute access
+
+	Lets a heavy dependency be named at module level without importing
+	it until a connection or parse needs it. An except clause naming
+	one imports it as soon as any exception reaches the clause, so
+	catch SQL errors with sql_errors() instead.
+	"""
+
+	def __init__(self, name):
+		self._name = name
+		self._module = None
+
+	def __getattr__(self, attr):
+		if self._module is None:
+			self._module = importlib.import_module(self._name)
+		return getattr(self._module, attr)
+
+# the error number of MySQL's (and SnapshotCursor's) missing table errors
+NO_SUCH_TABLE = 1146
+
+class SQLError(Exception):
+	"""Base of the errors of SQL cursors other than MySQLdb's
+
+	Like MySQLdb's, its args are the error number, if there is one, and
+	the message.
+	"""
+	pass
+
+def no_such_table(e):
+	"""True if the SQL error e says a table does not exist"""
+	return len(e.args) > 0 and e.args[0] == NO_SUCH_TABLE
+
+def sql_errors():
+	"""Returns the exception classes SQL cursors raise, for except clauses
+
+	MySQLdb.Error is only among them once MySQLdb has been imported, as
+	an error cannot be one of its own before, and looking it up would
+	import it, or fail where it is not installed.
+	"""
+	mysql = sys.modules.get("MySQLdb")
+	if mysql is None: return (SQLError,)
+	return (SQLError, mysql.Error)
+
 def sanitary_format( fmt, **kwargs ):
 	return fmt.format( **dict([(k, re.sub(r"[^\*_\w,]+", "", v)) for k,v in kwargs.items()]) )
 
+def normalize_html(t):
+	"""Gives the bare CHECKED and SELECTED attributes FreePBX emits a value
+
+	lxml would otherwise not see them as attributes. The output is the
+	same as that of the chained replacements
+
+		"CHECKED  -> " CHECKED, then  CHECKED  ->  CHECKED="checked" ,
+		"SELECTED -> " SELECTED, then SELECTED ->  SELECTED="selected" ,
+
+	with both attributes lowercased afterwards. The replacements write
+	lowercase directly, which saves the last pass, and the passes for a
+	word the page does not contain are skipped.
+	"""
+	if b"CHECKED" in t:
+		t = t.replace(b'"CHECKED ', b'" CHECKED ')
+		t = t.replace(b' CHECKED ', b' checked="checked" ')
+		t = t.replace(b"CHECKED", b"checked")
+
+	if b"SELECTED" in t:
+		# each SELECTED is replaced on its own, so the two passes are
+		# the same as the three of the chain
+		t = t.replace(b'"SELECTED', b'"  selected="selected" ')
+		t = t.replace(b"SELECTED", b' selected="selected" ')
+
+	return t
+
 def dump_error( gl, loc, tb, exception ):
 	import pprint
 	import traceback
@@ -15,20 +87,156 @@ def dump_error( gl, loc, tb, exception ):
 	out += pp.pformat(gl)
 	return out
 
-def matching_regex( regexes, s ):
-	for r, n in regexes.items():
-		ret = re.findall(r, s)
-		if len(ret): return {"key": n, "match": ret[0]}
+class RegexDispatcher:
+	"""Matches a string against a dict of {regex: key}, precompiled and memoized
 
-	return None
+	Returns {"key": key, "match": the first group, or the whole match}
+	for the first regex that matches, or None. All patterns are joined
+	into one alternation with a named group per pattern, so a string is
+	scanned once no matter how many patterns there are, and the result
+	for each string is remembered.
+	"""
+
+	def __init__(self, regexes):
+		parts = []
+		self._groups = []
+
+		group = 1
+		for i, (r, n) in enumerate(regexes.items()):
+			inner = re.compile(r).groups
+			parts.append("(?P<_%d>%s)" % (i, r))
+			self._groups.append((n, group + 1 if inner else group))
+			group += 1 + inner
+
+		self._regex = re.compile("|".join(parts)) if len(parts) else None
+		self._memo = {}
+
+	def match(self, s):
+		if s in self._memo: return self._memo[s]
+
+		ret = None
+		if self._regex is not None and s is not None:
+			m = self._regex.search(s)
+			if m is not None:
+				n, group = self._groups[int(m.lastgroup[1:])]
+				ret = {"key": n, "match": m.group(group)}
+
+		self._memo[s] = ret
+		return ret
+
+class ModuleGraph:
+	"""Which modules refer to which, built as modules are registered
+
+	Every edge runs from a module to one it shows rows of, and is of one
+	of three kinds: "fk" for a ForeignKeyField, "m2m" for a
+	ManyToManyField listing child rows, and "dest" for a
+	DestinationField, which may lead to any module with a dest_regex.
+	Targets may be registered after the modules referring to them.
+	"""
+
+	def __init__(self):
+		self._edges = {}
+		self._dest_users = set()
+		self._dest_targets = []
+
+	def add(self, name, edges, dest_user = False, dest_target = False):
+		"""Registers module name and its (target, kind) edges"""
+		self._edges[name] = list(edges)
+		if dest_user: self._dest_users.add(name)
+		if dest_target: self._dest_targets.append(name)
+
+	def names(self):
+		return list(self._edges.keys())
+
+	def edges(self, name):
+		"""Returns the (target, kind) edges of name to registered modules"""
+		edges = [e for e in self._edges.get(name, []) if e[0] in self._edges]
+		if name in self._dest_users:
+			edges += [(t, "dest") for t in self._dest_targets if (t, "dest") not in edges]
+		return edges
+
+	def dependencies(self, name, kinds = None):
+		"""Returns the modules name refers to directly"""
+		ret = []
+		for target, kind in self.edges(name):
+			if (kinds is None or kind in kinds) and target != name and target not in ret:
+				ret.append(target)
+		return ret
+
+	def dependents(self, name, kinds = None):
+		"""Returns the modules referring to name directly"""
+		return [n for n in self._edges if n != name and name in self.dependencies(n, kinds)]
+
+	def closure(self, name, kinds = None):
+		"""Returns every module reached from name through edges of kinds"""
+		ret = []
+		todo = [name]
+		while len(todo):
+			for target in self.dependencies(todo.pop(), kinds):
+				if target != name and target not in ret:
+					ret.append(target)
+					todo.append(target)
+		return ret
+
+	def invalidated_by(self, names, refers = None):
+		"""Returns the modules whose rendering changes when names change
+
+		Those are the modules referring to one of names, and, repeatedly,
+		the modules listing any of those as children. names themselves
+		are not included. refers(name, target) is asked to confirm every
+		"dest" edge, which otherwise only says a destination may lead
+		there.
+		"""
+		changed = set(names)
+		affected = []
+		for n in self._edges:
+			if n in changed: continue
+			for target, kind in self.edges(n):
+				if target not in changed: continue
+				if kind != "dest" or refers is None or refers(n, target):
+					affected.append(n)
+					break
+
+		todo = list(affected)
+		while len(todo):
+			for n in self.dependents(todo.pop(), ("m2m",)):
+				if n not in changed and n not in affected:
+					affected.append(n)
+					todo.append(n)
+
+		return [n for n in self._edges if n in affected]
+
+	def load_order(self, names = None):
+		"""Returns names (every module if None) with dependencies first
+
+		Only "fk" and "m2m" edges are followed; destinations commonly
+		lead back and forth between modules and do not order them.
+		"""
+		if names is None: names = self.names()
+
+		order = []
+		visiting = set()
+		def visit(n):
+			if n in order or n in visiting: return
+			visiting.add(n)
+			for target in self.dependencies(n, ("fk", "m2m")): visit(target)
+			order.append(n)
+
+		for n in names: visit(n)
+		return [n for n in order if n in names]
 
 def module(pbx, name):
 	if name in module.registry:
 		return module.registry[name](pbx)
 	return None
 
+def dest_resolver():
+	if getattr(module, "resolver", None) is None:
+		module.resolver = RegexDispatcher(module.regex_registry)
+	return module.resolver
+
 def dest(pbx, name):
-	match = matching_regex( module.regex_registry, name )
+	match = dest_resolver().match(name)
 	if match is not None:
 		return module.registry[match["key"]](pbx).get(match["match"])
 	return name
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""Compares PBXUtil.normalize_html with the chained replace() it replaced
+
+Usage: bench_normalize.py [page.html ...]
+
+Without arguments synthetic extension-list sized pages are used. Exits
+with status 1 if normalize_html is slower than the chain on any page.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from PBXUtil import normalize_html
+
+def legacy_normalize_html(t):
+	t = t.replace(b'"CHECKED ', b'" CHECKED ')
+	t = t.replace(b' CHECKED ', b' CHECKED="checked" ')
+	t = t.replace(b"CHECKED", b"checked")
+
+	t = t.replace(b'"SELECTED', b'" SELECTED')
+	t = t.replace(b'SELECTED', b' SELECTED="selected" ')
+	t = t.replace(b"SELECTED", b"selected")
+	return t
+
+def synthetic_page(rows = 5000, dense = True):
+	"""Extension list sized page
+
+	A dense page has boolean attributes on every row, a sparse one a
+	single SELECTED option every 50 rows, which is closer to most
+	FreePBX config pages.
+	"""
+	row = b'<tr><td><a href="config.php?display=extensions&extdisplay=%d">%d</a></td><td>User %d</td></tr>\n'
+	dense_row = (b'<tr><td><input type="checkbox" name="ext%d" CHECKED /></td>'
+		b'<td><input type="radio" value="%d"CHECKED ></td>'
+		b'<td><select><option value="a" SELECTED>a</option><option value="b">b</option>'
+		b'<option value="c"SELECTED>c</option></select></td>'
+		b'<td><textarea id="members">%d,0\n</textarea></td></tr>\n')
+	sparse_row = b'<tr><td><select><option value="%d" SELECTED>%d</option></select></td><td>%d</td></tr>\n'
+
+	body = []
+	for i in range(rows):
+		if dense: body.append(dense_row % (i, i, i))
+		elif i % 50 == 0: body.append(sparse_row % (i, i, i))
+		else: body.append(row % (i, i, i))
+
+	return b"<html><body><table>\n" + b"".join(body) + b"</table></body></html>"
+
+def main(paths):
+	if len(paths):
+		pages = [(p, open(p, "rb").read()) for p in paths]
+	else:
+		pages = [("synthetic, sparse", synthetic_page(dense = False)),
+			("synthetic, dense", synthetic_page(dense = True))]
+
+	number = 20
+	slower = []
+	for title, page in pages:
+		if normalize_html(page) != legacy_normalize_html(page):
+			sys.exit("%s: normalize_html output differs from the legacy implementation" % title)
+
+		print("%s (%d bytes)" % (title, len(page)))
+		times = []
+		for name, func in (("legacy replace() chain", legacy_normalize_html), ("normalize_html", normalize_html)):
+			best = min(timeit.repeat(lambda: func(page), number = number, repeat = 5))
+			times.append(best)
+			print("  %-24s %8.2f ms/run  %8.1f MB/s" % (name, best / number * 1000, len(page) * number / best / 1e6))
+
+		# a few percent of timing noise is allowed
+		if times[1] > times[0] * 1.05: slower.append(title)
+
+	if len(slower):
+		sys.exit("normalize_html is slower than the legacy chain on: " + ", ".join(slower))
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
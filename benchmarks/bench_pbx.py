@@ -0,0 +1,354 @@
+#!/usr/bin/python
+"""Renders the wiki of a synthetic PBX against local stand-ins
+
+Usage: bench_pbx.py [--snapshot] [-j JOBS] [extensions ...]
+
+For every scale point (100, 1000 and 5000 extensions by default) a
+FreePBX configuration is generated with proportional numbers of IVRs,
+queues, ring groups, time conditions, announcements and the rest. The
+tables go into an SQLite database whose columns are typed after the
+module fields, queried through a DictCursor look-alike, and config
+pages are served by a local HTTP server in a child process, so PBX
+talks HTTP as it does to a real box.
+
+Each module with a template is then rendered on a fresh PBX, cold, and
+its wall time, SQL query count, config page fetch count and peak
+traced memory are printed, followed by the whole document as
+document() writes it. Times come from an untraced run, as tracemalloc
+slows allocation down several times.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from PBX import PBX
+from PBXRender import environment, render_module, document
+from PBXSnapshot import SnapshotCursor
+from PBXUtil import module, sanitary_format
+from ModuleField import ModuleField, StringField, ListField, DestinationField, ManyToManyField
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "templates")
+
+def counts(extensions):
+	"""Number of rows of each object for a PBX with that many extensions"""
+	n = lambda per: max(extensions // per, 1)
+	return {
+		"extensions": extensions,
+		"recordings": n(20),
+		"ivrs": n(50),
+		"ringgroups": n(25),
+		"queues": n(50),
+		"timegroups": n(200),
+		"timeconditions": n(100),
+		"dids": n(10),
+		"announcements": n(100),
+		"directories": n(500),
+		"miscdests": n(100),
+		"miscapps": n(200),
+		"callrecordings": n(200),
+		"admins": n(500) + 1,
+		"customdests": n(200),
+		"customextens": n(200),
+		"blacklist": n(10),
+	}
+
+def first_extension(i):
+	return 1000 + i
+
+def queue_members(queue, c):
+	# five extensions per queue, wrapping around
+	return [first_extension((queue * 5 + k) % c["extensions"]) for k in range(5)]
+
+def columns(cls):
+	"""(name, affinity) of the table columns of module cls
+
+	Only text-like fields get TEXT affinity; the rest are NUMERIC, so
+	numeric strings compare equal to numbers as they do in MySQL while
+	special values such as "" and "default" are kept as they are.
+	"""
+	cols = []
+	for name, f in cls.fields.items():
+		if isinstance(f, ManyToManyField) or f.xpath_location is not None: continue
+		text = isinstance(f, (StringField, ListField, DestinationField)) or type(f) is ModuleField
+		cols.append((name, "TEXT" if text else "NUMERIC"))
+	return cols
+
+def generate(path, c, seed = 0):
+	"""Writes the module tables of a synthetic PBX of size c to path"""
+	rnd = random.Random(seed)
+	pick = lambda n: rnd.randint(1, n)
+
+	ext = lambda: first_extension(pick(c["extensions"]) - 1)
+	destinations = [
+		lambda: "from-did-direct,%d,1" % ext(),
+		lambda: "ext-local,vm%s%d,1" % (rnd.choice("bus"), ext()),
+		lambda: "ivr-%d,s,1" % pick(c["ivrs"]),
+		lambda: "ext-group,%d,1" % (600 + pick(c["ringgroups"])),
+		lambda: "ext-queues,%d,1" % (700 + pick(c["queues"])),
+		lambda: "app-announcement-%d,s,1" % pick(c["announcements"]),
+		lambda: "directory,%d,1" % pick(c["directories"]),
+		lambda: "ext-miscdests,%d,1" % pick(c["miscdests"]),
+		lambda: "ext-callrecording,%d,1" % pick(c["callrecordings"]),
+		lambda: "app-blackhole,%s,1" % rnd.choice(["hangup", "busy", "congestion"]),
+		lambda: "ext-featurecodes,*97,1",
+	]
+	dest = lambda: rnd.choice(destinations)()
+	recording = lambda: rnd.choice([0, pick(c["recordings"])])
+
+	tables = {
+		"users": [{"extension": first_extension(i), "name": "User %d" % i} for i in range(c["extensions"])],
+		"recordings": [{"id": i, "displayname": "Recording %d" % i, "filename": "custom/rec%d" % i,
+			"fcode": i % 2, "fcode_pass": ""} for i in range(1, c["recordings"] + 1)],
+		"incoming": [{"extension": "555%04d" % i, "description": "DID %d" % i,
+			"destination": "timeconditions,%d,1" % pick(c["timeconditions"]) if i % 2 else dest(),
+			"notes": ""} for i in range(1, c["dids"] + 1)],
+		"timegroups_groups": [{"id": i, "description": "Time group %d" % i} for i in range(1, c["timegroups"] + 1)],
+		"timegroups_details": [{"id": 2 * i + k, "timegroupid": i, "time": t}
+			for i in range(1, c["timegroups"] + 1) for k, t in enumerate(["09:00-17:00|mon-fri|*|*", "*|sat|*|*"])],
+		"timeconditions": [{"timeconditions_id": i, "displayname": "Office hours %d" % i,
+			"time": pick(c["timegroups"]), "truegoto": "ivr-%d,s,1" % pick(c["ivrs"]), "falsegoto": dest()}
+			for i in range(1, c["timeconditions"] + 1)],
+		"ivr_details": [{"id": i, "name": "IVR %d" % i, "description": "Menu %d" % i,
+			"announcement": recording(), "directdial": rnd.choice(["", "ext-local", pick(c["directories"])]),
+			"timeout_time": 10, "invalid_loops": 3, "invalid_retry_recording": "default",
+			"invalid_append_announce": 0, "invalid_recording": "default", "invalid_destination": dest(),
+			"timeout_loops": 3, "timeout_retry_recording": "", "timeout_append_announce": 1,
+			"timeout_recording": recording() or "", "timeout_destination": dest(), "retvm": "on"}
+			for i in range(1, c["ivrs"] + 1)],
+		"ivr_entries": [{"ivr_id": i, "selection": str(k), "dest": dest()}
+			for i in range(1, c["ivrs"] + 1) for k in range(1, 6)],
+		"ringgroups": [{"grpnum": 600 + i, "description": "Ring group %d" % i, "strategy": "ringall",
+			"grptime": 20, "grplist": "-".join([str(ext()) for k in range(5)]), "annmsg_id": recording(),
+			"ringing": "Ring", "grppre": "", "alertinfo": "", "cfignore": "CHECKED", "cwignore": "",
+			"cpickup": "", "needsconf": "", "remotealert_id": 0, "toolate_id": 0, "postdest": dest()}
+			for i in range(1, c["ringgroups"] + 1)],
+		"queues_config": [{"extension": 700 + i, "descr": "Queue %d" % i, "password": "", "togglehint": 1,
+			"callconfirm": 0, "callconfirm_id": 0, "grppre": "", "queuewait": 0, "alertinfo": "",
+			"dest": dest()} for i in range(1, c["queues"] + 1)],
+		"announcement": [{"announcement_id": i, "description": "Announcement %d" % i,
+			"recording_id": recording(), "allow_skip": 0, "return_ivr": 1, "noanswer": 0, "repeat_msg": "",
+			"post_dest": dest()} for i in range(1, c["announcements"] + 1)],
+		"directory_details": [{"id": i, "dirname": "Directory %d" % i, "description": "", "callid_prefix": "",
+			"alert_info": "", "announcement": recording(), "repeat_loops": 2, "repeat_recording": "",
+			"invalid_recording": 0, "invalid_destination": dest(), "retivr": "1", "say_extension": ""}
+			for i in range(1, c["directories"] + 1)],
+		"directory_entries": [{"id": i, "e_id": i % c["directories"] + 1, "name": "", "audio": "vm",
+			"type": "user", "foreign_id": first_extension(i % c["extensions"]), "dial": ""}
+			for i in range(1, c["extensions"] + 1)],
+		"miscdests": [{"id": i, "description": "Misc destination %d" % i, "destdial": 5550000 + i}
+			for i in range(1, c["miscdests"] + 1)],
+		"miscapps": [{"miscapps_id": i, "ext": "*4%d" % i, "description": "Misc application %d" % i,
+			"dest": dest()} for i in range(1, c["miscapps"] + 1)],
+		"callrecording": [{"callrecording_id": i, "description": "Call recording %d" % i,
+			"callrecording_mode": rnd.choice(["", "delayed", "force", "never"]), "dest": dest()}
+			for i in range(1, c["callrecordings"] + 1)],
+		"parkplus": [{"id": 1, "parkext": 70, "name": "Default lot", "parkpos": 71, "numslots": 8,
+			"parkingtime": 45, "parkedmusicclass": "default", "generatehints": "yes", "findslot": "first",
+			"parkedplay": "both", "parkedcalltransfers": "caller", "parkedcallreparking": "both",
+			"alertinfo": "", "cidpp": "", "autocidpp": "", "announcement_id": 0, "comebacktoorigin": "no",
+			"dest": dest()}],
+		"ampusers": [{"username": "admin%d" % i, "password_sha1": "%040x" % i, "deptname": "",
+			"extension_low": 0, "extension_high": 0, "sections": "*"} for i in range(1, c["admins"] + 1)],
+		"custom_destinations": [{"custom_dest": "custom-dest-%d,s,1" % i, "description": "Custom destination %d" % i,
+			"notes": ""} for i in range(1, c["customdests"] + 1)],
+		"custom_extensions": [{"custom_exten": "99%d" % i, "description": "Custom extension %d" % i,
+			"notes": ""} for i in range(1, c["customextens"] + 1)],
+		"featurecodes": [{"modulename": "voicemail", "featurename": "myvoicemail", "defaultcode": "*97",
+			"customcode": "", "description": "My Voicemail", "enabled": 1}] +
+			[{"modulename": "core", "featurename": "feature%d" % i, "defaultcode": "*%d" % (10 + i),
+			"customcode": "", "description": "Feature code %d" % i, "enabled": i % 2} for i in range(60)],
+	}
+
+	if os.path.exists(path): os.remove(path)
+	db = sqlite3.connect(path)
+	for cls in module.registry.values():
+		if not hasattr(cls, "db_table"): continue
+		cols = columns(cls)
+		db.execute(sanitary_format("CREATE TABLE {table} ", table = cls.db_table) +
+			"(%s)" % ", ".join([sanitary_format("{col} ", col = n) + a for n, a in cols]))
+		db.executemany(sanitary_format("INSERT INTO {table} VALUES ", table = cls.db_table) +
+			"(%s)" % ", ".join(["?"] * len(cols)),
+			[[row.get(n) for n, a in cols] for row in tables.get(cls.db_table, [])])
+	db.commit()
+	db.close()
+
+def config_page(query, c):
+	"""HTML of the config.php page for the parsed query string"""
+	display = query.get("display", [""])[0]
+	if display == "queues":
+		queue = int(query["extdisplay"][0]) - 700
+		members = "\n".join(["Local/%d@from-queue/n,0" % e for e in queue_members(queue, c)])
+		return ('<html><body><form><input type="checkbox" name="togglehint" CHECKED>'
+			'<textarea id="members">%s</textarea><textarea id="dynmembers"></textarea>'
+			'</form></body></html>' % members).encode()
+
+	if display == "blacklist":
+		rows = "".join(['<tr><td>555%04d</td><td>Caller %d</td></tr>' % (i, i) for i in range(c["blacklist"])])
+		return ('<html><body><table><tr><td><h5>Blacklist entries</h5></td></tr>'
+			'<tr><th>Number</th><th>Description</th></tr>%s</table></body></html>' % rows).encode()
+
+	return b"<html><body><form></form></body></html>"
+
+def serve(c, ready):
+	class Handler(BaseHTTPRequestHandler):
+		def reply(self, body):
+			self.send_response(200)
+			self.send_header("Content-Type", "text/html")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			self.reply(config_page(parse_qs(urlparse(self.path).query), c))
+
+		def do_POST(self):
+			self.rfile.read(int(self.headers.get("Content-Length", 0)))
+			self.reply(b"<html><body>Logged in</body></html>")
+
+		def log_message(self, *args):
+			pass
+
+	server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+	ready.put(server.server_address[1])
+	server.serve_forever()
+
+class BenchPBX(PBX):
+	"""PBX reading its tables from a generated SQLite database
+
+	Config pages are fetched over HTTP from the address given, as PBX
+	does, and counted. Queries are counted by the PBX's stats, which
+	record every statement the modules run.
+	"""
+
+	def __init__(self, address, db_path, **kwargs):
+		PBX.__init__(self, address, **kwargs)
+		self._db_path = db_path
+		self._db_local = threading.local()
+		self._bench_lock = threading.Lock()
+		self.fetches = 0
+
+	@property
+	def queries(self):
+		"""Number of statements recorded in stats since it was reset"""
+		return sum([h["count"] for methods in self.stats.to_dict()["sql"].values() for h in methods.values()])
+
+	def _db(self):
+		db = getattr(self._db_local, "db", None)
+		if db is None:
+			db = sqlite3.connect("file:%s?mode=ro" % self._db_path, uri = True, check_same_thread = False)
+			self._db_local.db = db
+		return db
+
+	def connect_sql( self, username, password ):
+		self._sql_connected = True
+		if self._snapshot_mode:
+			self.load_snapshot()
+
+	def get_sql_cursor( self ):
+		return SnapshotCursor(self._db())
+
+	def _fetch_page( self, url ):
+		with self._bench_lock: self.fetches += 1
+		return PBX._fetch_page(self, url)
+
+def measure(setup, run):
+	"""Wall time, queries, page fetches and peak memory of run(setup())
+
+	Only run is timed and traced; the counters are reset after setup.
+	"""
+	pbx = setup()
+	pbx.stats.reset()
+	pbx.fetches = 0
+	start = time.perf_counter()
+	run(pbx)
+	elapsed = time.perf_counter() - start
+	queries, fetches = pbx.queries, pbx.fetches
+	pbx.close()
+
+	pbx = setup()
+	tracemalloc.start()
+	run(pbx)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	pbx.close()
+	return elapsed, queries, fetches, peak
+
+def report(name, rows, result):
+	elapsed, queries, fetches, peak = result
+	print("  %-20s %7s %9.1f %8d %6d %8.1f" % (name, rows, elapsed * 1000, queries, fetches, peak / 1e6))
+
+def bench(address, db_path, snapshot, jobs, workdir):
+	j2_env = environment(TEMPLATES)
+	setup = lambda: BenchPBX(address, db_path, snapshot = snapshot)
+
+	def connect(pbx):
+		pbx.connect_web_config("admin", "admin")
+		pbx.connect_sql("root", "")
+
+	def connected():
+		pbx = setup()
+		connect(pbx)
+		return pbx
+
+	print("  %-20s %7s %9s %8s %6s %8s" % ("module", "rows", "wall ms", "queries", "pages", "peak MB"))
+	report("(connect)", "", measure(setup, connect))
+
+	for name, cls in module.registry.items():
+		if cls.render_template is None: continue
+
+		pbx = connected()
+		rows = len(pbx[name])
+		pbx.close()
+		if rows == 0: continue
+
+		def render(pbx):
+			m = pbx[name]
+			if len(m) > 0:
+				pbx.prewarm([cls])
+				for chunk in render_module(j2_env, m): pass
+
+		report(name, rows, measure(connected, render))
+
+	out = os.path.join(workdir, "wiki.txt")
+	report("(document)", "", measure(connected, lambda pbx: document(pbx, j2_env, out, jobs)))
+	os.remove(out)
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark rendering a synthetic PBX")
+	parser.add_argument("extensions", nargs = "*", type = int, default = [100, 1000, 5000])
+	parser.add_argument("--snapshot", action = "store_true", help = "Use snapshot mode")
+	parser.add_argument("-j", "--jobs", type = int, default = 1, help = "Workers rendering the document")
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp()
+	for extensions in args.extensions:
+		c = counts(extensions)
+		db_path = os.path.join(workdir, "pbx-%d.db" % extensions)
+		generate(db_path, c)
+
+		ready = multiprocessing.Queue()
+		server = multiprocessing.Process(target = serve, args = (c, ready), daemon = True)
+		server.start()
+		address = "127.0.0.1:%d" % ready.get()
+
+		print("%d extensions%s, %d jobs" % (extensions, ", snapshot mode" if args.snapshot else "", args.jobs))
+		try:
+			bench(address, db_path, args.snapshot, args.jobs, workdir)
+		finally:
+			server.terminate()
+			server.join()
+			os.remove(db_path)
+	os.rmdir(workdir)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+"""Compares the memory taken by module rows with per-row field copies
+
+Usage: bench_rows.py [rows]
+
+Rows of FeatureCode and DirectoryEntry, the largest tables on most
+PBXes, are built from synthetic columns both ways with every field
+converted, and the memory they keep alive is measured with tracemalloc.
+"""
+import os
+import sys
+import time
+import tracemalloc
+from copy import copy
+from collections import OrderedDict as ODict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from PBXModule import FeatureCode, DirectoryEntry
+
+class RowHolder:
+	"""Stands in for the PBX identity map, keeping every row alive"""
+	def __init__(self):
+		self.rows = []
+
+	def cache_row(self, cls, pk, obj):
+		self.rows.append(obj)
+
+def legacy_row(cls, pbx, row):
+	# an ordered dict of shallow field copies, each holding its value,
+	# as Module.from_row made them before the fields were shared
+	fields = ODict()
+	for name, info in cls.fields.items():
+		f = copy(info)
+		f.value = None if row.get(name) is None else info.convert(pbx, row[name])
+		f.pbx = pbx
+		fields[name] = f
+	return fields
+
+def compact_row(cls, pbx, row):
+	obj = cls.from_row(pbx, row)
+	for k, v in obj: pass
+	return obj
+
+def synthetic_rows(cls, count):
+	if cls is FeatureCode:
+		return [{"modulename": "core", "featurename": "feature%d" % i, "defaultcode": "*%d" % i,
+			"customcode": "", "description": "Feature code number %d" % i, "enabled": 1} for i in range(count)]
+	return [{"id": i, "e_id": i % 10, "name": "Directory entry %d" % i, "audio": "vm",
+		"type": "custom", "foreign_id": None, "dial": str(1000 + i)} for i in range(count)]
+
+def measure(build, cls, rows):
+	# timed untraced, as tracemalloc slows allocation down several times
+	start = time.perf_counter()
+	kept = [build(cls, RowHolder(), row) for row in rows]
+	elapsed = time.perf_counter() - start
+	del kept
+
+	tracemalloc.start()
+	pbx = RowHolder()
+	kept = [build(cls, pbx, row) for row in rows]
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return size, elapsed, kept
+
+def main(count):
+	for cls in (FeatureCode, DirectoryEntry):
+		rows = synthetic_rows(cls, count)
+		print("%s, %d rows of %d fields" % (cls.__name__, count, len(cls.fields)))
+		for name, build in (("field copies", legacy_row), ("compact rows", compact_row)):
+			size, elapsed, kept = measure(build, cls, rows)
+			print("  %-14s %8.1f MB  %6d bytes/row  %7.1f ms" % (name, size / 1e6, size / count, elapsed * 1000))
+			del kept
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""Checks the time taken to import the modules the scripts start with
+
+Usage: bench_startup.py [--budget-ms MS] [--runs N]
+
+Imports PBX, PBXRender and PBXSnapshot in a fresh interpreter under
+python -X importtime, N times, and prints the best total and the
+slowest imports of that run. Exits with status 1 if the total is over
+the budget or if any of the heavy dependencies that are only needed
+once connecting or parsing (requests, MySQLdb, lxml.html, sshtunnel,
+paramiko) was imported.
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MODULES = ["PBX", "PBXRender", "PBXSnapshot"]
+HEAVY = ["requests", "MySQLdb", "lxml.html", "sshtunnel", "paramiko"]
+
+def import_times():
+	"""Imports MODULES in a fresh interpreter
+
+	Returns its imports as (name, self us, cumulative us, depth) and
+	the HEAVY modules it loaded.
+	"""
+	code = "import sys\nimport %s\nprint(' '.join([m for m in %r if m in sys.modules]))" % (", ".join(MODULES), HEAVY)
+	p = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd = ROOT,
+		stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True, check = True)
+
+	times = []
+	for line in p.stderr.splitlines():
+		if not line.startswith("import time:") or "self [us]" in line: continue
+		self_us, cumulative, name = line[len("import time:"):].split("|")
+		depth = (len(name) - len(name.lstrip())) // 2
+		times.append((name.strip(), int(self_us), int(cumulative), depth))
+	return times, p.stdout.split()
+
+def main():
+	parser = argparse.ArgumentParser(description = "Check the import time of pbx-tools")
+	parser.add_argument("--budget-ms", type = float, default = 150, help = "maximum total import time")
+	parser.add_argument("--runs", type = int, default = 5, help = "number of interpreters to take the best of")
+	args = parser.parse_args()
+
+	best = None
+	for i in range(args.runs):
+		times, heavy = import_times()
+		# each of MODULES is listed at the top level, with the time of
+		# whatever it imported that an earlier one had not
+		total = sum([c for name, s, c, depth in times if depth == 0 and name in MODULES])
+		if best is None or total < best[0]: best = (total, times, heavy)
+
+	total, times, heavy = best
+	print("import %s: %.1f ms (best of %d, budget %.0f ms)" % (", ".join(MODULES), total / 1000, args.runs, args.budget_ms))
+	print("slowest imports:")
+	for name, self_us, cumulative, depth in sorted(times, key = lambda t: -t[1])[:10]:
+		print("  %-40s %8.1f ms self %8.1f ms cumulative" % (name, self_us / 1000, cumulative / 1000))
+
+	failed = False
+	if len(heavy):
+		print("imported at startup: " + ", ".join(heavy))
+		failed = True
+	if total / 1000 > args.budget_ms:
+		print("over budget")
+		failed = True
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
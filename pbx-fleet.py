@@ -0,0 +1,69 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PBX import PBX, PBXError
+from PBXRender import environment, document
+
+parser = argparse.ArgumentParser(description = "Document many FreePBX servers at once")
+parser.add_argument("inventory", help = "JSON file listing the PBXes, see README.md")
+parser.add_argument("-c", "--concurrency", type = int, default = 8, help = "number of PBXes documented at once")
+parser.add_argument("-j", "--jobs", type = int, default = 1, help = "number of modules rendered concurrently per PBX")
+parser.add_argument("-o", "--output-dir", default = ".", help = "directory the per-host wiki files are written to")
+parser.add_argument("--cache-dir", help = "keep scraped config pages in this directory across runs")
+parser.add_argument("--cache-ttl", type = float, help = "seconds a cached page is used before revalidating it (default: always revalidate)")
+parser.add_argument("--timeout", type = float, default = 30, help = "seconds to wait for a PBX to answer before failing it")
+parser.add_argument("-v", "--verbose", action = "store_true", help = "print per-host progress")
+args = parser.parse_args()
+
+with open(args.inventory) as f:
+	inventory = json.load(f)
+
+os.makedirs(args.output_dir, exist_ok = True)
+j2_env = environment()
+
+def run(entry):
+	host = entry["host"]
+	output = os.path.join(args.output_dir, entry.get("output", host + ".wiki.txt"))
+	start = time.time()
+	error = None
+
+	pbx = None
+	try:
+		pbx = PBX(host, snapshot = True, page_cache_dir = args.cache_dir, page_cache_ttl = args.cache_ttl,
+			timeout = args.timeout)
+		def echo(str): print("[%s] %s" % (host, str))
+		if args.verbose: pbx.set_update_targets(status = echo)
+
+		pbx.connect_web_config(entry["username"], entry["password"])
+		pbx.connect_sql(entry.get("ssh_username", entry["username"]), entry.get("ssh_password", entry["password"]))
+
+		document(pbx, j2_env, output, args.jobs)
+	except PBXError as e:
+		error = str(e) or "PBX error"
+	except Exception as e:
+		error = repr(e)
+		if args.verbose: traceback.print_exc()
+	finally:
+		if pbx is not None: pbx.close()
+
+	return host, output, time.time() - start, error
+
+results = []
+with ThreadPoolExecutor(args.concurrency) as pool:
+	for future in as_completed([pool.submit(run, entry) for entry in inventory]):
+		host, output, elapsed, error = future.result()
+		if error is None: print("%s: wrote %s in %.1fs" % (host, output, elapsed))
+		else: print("%s: FAILED after %.1fs: %s" % (host, elapsed, error))
+		results.append((host, elapsed, error))
+
+failed = [r for r in results if r[2] is not None]
+print("\n%d of %d PBXes documented" % (len(results) - len(failed), len(results)))
+for host, elapsed, error in sorted(results, key = lambda r: -r[1]):
+	print("  %-30s %7.1fs  %s" % (host, elapsed, "ok" if error is None else error))
+
+sys.exit(1 if len(failed) else 0)
@@ -1,40 +1,83 @@
 #!/usr/bin/python
+import argparse
 import logging
 import sys
+import time
 from PBX import PBX, PBXError
 from getpass import getpass
-from jinja2 import Environment, FileSystemLoader
-from PBXUtil import dump_error
+from PBXRender import environment, document, WikiDocument
+from PBXSnapshot import SnapshotPBX, export_snapshot
+from PBXUtil import dump_error, sql_errors
 
-username = input("Enter PBX username:")
-password = getpass("Enter PBX password:")
+parser = argparse.ArgumentParser(description = "FreePBX Asterisk documentation generator")
+parser.add_argument("host", help = "IP or domain name of the PBX, or the snapshot file with --from-snapshot")
+parser.add_argument("--cache-dir", help = "keep scraped config pages in this directory across runs")
+parser.add_argument("--cache-ttl", type = float, help = "seconds a cached page is used before revalidating it (default: always revalidate)")
+parser.add_argument("--offline", action = "store_true", help = "use cached pages only, without logging in to the web GUI")
+parser.add_argument("--page-cache-mb", type = float, default = 64, help = "memory budget for scraped config pages")
+parser.add_argument("--compress-pages", action = "store_true", help = "keep cached pages compressed and parse them on use")
+parser.add_argument("-j", "--jobs", type = int, default = 1, help = "number of modules rendered concurrently")
+parser.add_argument("--interval", type = float, help = "keep running, updating the wiki for changed tables every INTERVAL seconds")
+parser.add_argument("--export", metavar = "FILE", help = "write the configuration to a snapshot file instead of a wiki")
+parser.add_argument("--from-snapshot", action = "store_true", help = "document a snapshot file written with --export, without connecting")
+parser.add_argument("--stats", metavar = "FILE", help = "write query, page and render statistics to FILE as JSON")
+parser.add_argument("--trace", metavar = "FILE", help = "write every query, page fetch and render to FILE as a Chrome trace")
+args = parser.parse_args()
 
+if not args.from_snapshot:
+	username = input("Enter PBX username:")
+	password = getpass("Enter PBX password:")
+
+pbx = None
 try:
-	pbx = PBX(sys.argv[1])
+	if args.from_snapshot:
+		pbx = SnapshotPBX(args.host, page_cache_bytes = int(args.page_cache_mb * 1024 * 1024),
+			compress_page_cache = args.compress_pages, trace = args.trace is not None)
+	else:
+		pbx = PBX(args.host, snapshot = True, page_cache_dir = args.cache_dir,
+			page_cache_ttl = args.cache_ttl, trust_page_cache = args.offline,
+			page_cache_bytes = int(args.page_cache_mb * 1024 * 1024), compress_page_cache = args.compress_pages,
+			trace = args.trace is not None)
 
 	def echo(str): print(str)
-	pbx.set_update_targets(echo, echo, echo)
-
-	pbx.connect_web_config(username, password)
-	pbx.connect_sql(username, password)
-
-	j2_env = Environment(loader=FileSystemLoader("./templates"), trim_blocks=True)
-	j2_env.filters["capfirst"] = lambda s: s[0].upper() + s[1:]
-
-	def j2_debug(s): print(s)
-	j2_env.filters["debug"] = j2_debug
+	def percent(p): print("%d%% written" % p)
+	pbx.set_update_targets(percent, echo, echo)
 
-	to_render = []
-	for m in pbx:
-		if m.render_template is not None and len(m) > 0: to_render.append(m)
+	if not args.from_snapshot:
+		if not args.offline:
+			pbx.connect_web_config(username, password)
+		pbx.connect_sql(username, password)
 
-	f = open("wiki.txt", "w")
-	out = ""
-	for m in to_render:
-		out += j2_env.get_template("wiki.tpl").render(m=m, nl="\n").replace("\t", "")
+	if args.export is not None:
+		export_snapshot(pbx, args.export)
+	elif args.interval is None:
+		document(pbx, environment(), "wiki.txt", args.jobs)
+	else:
+		wiki = WikiDocument(pbx, environment(), "wiki.txt", args.jobs)
+		wiki.refresh()
+		while True:
+			time.sleep(args.interval)
+			try:
+				updated = wiki.refresh()
+			except PBXError as e:
+				pbx.update_status("Update failed: %s" % e)
+				continue
+			except sql_errors() as e:
+				# the connection may be gone; the next update opens another
+				pbx.update_status("Update failed: %s" % e)
+				pbx.release_sql(broken = True)
+				continue
+			pbx.update_status("Updated %d modules: %s" % (len(updated), ", ".join([cls.__name__ for cls in updated])))
 
-	pbx.update_status("Writing output")
-	f.write(out)
+	if "disk_pages" in pbx.cache_stats():
+		pbx.update_status("Page cache: %(hits)d hits, %(misses)d misses, %(stale)d stale, %(revalidated)d revalidated" % pbx.cache_stats()["disk_pages"])
+	if pbx.sql_pool_stats() is not None:
+		pbx.update_status("SQL pool: %(created)d connections, %(acquired)d acquired, %(waits)d waits (%(max_wait).2fs max)" % pbx.sql_pool_stats())
 
 finally:
-	pbx.close()
+	if pbx is not None:
+		if args.stats is not None:
+			pbx.stats.write_json(args.stats, {"cache": pbx.cache_stats(), "sql_pool": pbx.sql_pool_stats()})
+		if args.trace is not None:
+			pbx.stats.write_chrome_trace(args.trace)
+		pbx.close()
@@ -1,4 +1,4 @@
-{% for c in m.all() %}
+{% for c in m.iter_all() %}
 	=== <div id="{{c.uid()}}">{% if m.config_param is defined %}[{{c.config_url()}} {{m.item_name}}: {{c}}]{% else %}{{m.item_name}}: {{c}}{% endif %}</div> ===
 	{% for k,v in c if v.description != "" %}
 		{% if v.value is iterable and v.value|length > 0 and v.value[0] is not string %}
@@ -3,7 +3,7 @@
 	!{{f.description|capfirst}}
 {% endfor %}
 |----
-{% for c in m.all() %}
+{% for c in m.iter_all() %}
 	{% for k,v in c %}
 		{%if v.description != "" %}|{{v}}
 		{% endif %}